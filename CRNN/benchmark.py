@@ -0,0 +1,401 @@
+import os
+import json
+import time
+import shutil
+import tempfile
+import numpy as np
+import tensorflow as tf
+
+from PIL import Image
+from crnn import CRNN
+from predictor import Predictor
+from utils import (
+    resize_image,
+    label_to_array,
+    sparse_tuple_from,
+    normalize_batch,
+    compute_seq_len,
+    session_config,
+)
+
+IMAGE_DIRS = [
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "samples"),
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "test"),
+]
+
+
+def rss_mb():
+    """
+        Current resident set size, unlike ru_maxrss it goes down again after
+        a larger configuration ran
+    """
+
+    with open("/proc/self/statm") as f:
+        return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE") / 2.0 ** 20
+
+
+def measure(fn, repeats, warmup=1):
+    """
+        Call fn warmup + repeats times, return the duration of the last repeats
+        calls and the RSS before and after all of them
+    """
+
+    rss_before = rss_mb()
+    for _ in range(warmup):
+        fn()
+
+    timings = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        fn()
+        timings.append(time.perf_counter() - start)
+    return timings, rss_before, rss_mb()
+
+
+def summarize(stage, measurement, images, **params):
+    """
+        Throughput, latency percentiles and RSS of a stage processing images
+        per call, measurement is the result of measure
+    """
+
+    timings, rss_before, rss_after = measurement
+    timings_ms = np.array(timings) * 1000
+    result = {"stage": stage}
+    result.update(params)
+    result.update(
+        {
+            "calls": len(timings),
+            "images_per_second": images * len(timings) / max(sum(timings), 1e-9),
+            "p50_ms": float(np.percentile(timings_ms, 50)),
+            "p95_ms": float(np.percentile(timings_ms, 95)),
+            "p99_ms": float(np.percentile(timings_ms, 99)),
+            "rss_mb": rss_after,
+            "rss_growth_mb": rss_after - rss_before,
+        }
+    )
+    print(
+        "\t{:<16} {:>10.1f} images/s  p50 {:.2f} ms  p99 {:.2f} ms  RSS {:.0f} MB ({:+.1f})".format(
+            stage,
+            result["images_per_second"],
+            result["p50_ms"],
+            result["p99_ms"],
+            result["rss_mb"],
+            result["rss_growth_mb"],
+        )
+    )
+    return result
+
+
+def list_images(image_dirs):
+    """
+        Image files of image_dirs with their label, named like training examples
+        (label_anything.ext) or after their label
+    """
+
+    images = []
+    for d in image_dirs:
+        for f in sorted(os.listdir(d)):
+            name, ext = os.path.splitext(f)
+            if ext.lower() in (".jpg", ".jpeg", ".png"):
+                images.append((os.path.join(d, f), name.split("_")[0]))
+    if not images:
+        raise Exception("No image found in {}".format(", ".join(image_dirs)))
+    return images
+
+
+def write_examples(images, path, count, max_char_count):
+    """
+        Fill path with count copies of images named for DataManager.load_data,
+        labels are truncated so that none is filtered out
+    """
+
+    for i in range(count):
+        f, label = images[i % len(images)]
+        label = label[:max_char_count]
+        shutil.copy(f, os.path.join(path, "{}_{}{}".format(label, i, os.path.splitext(f)[1])))
+
+
+def benchmark_data(images, char_vector, batch_size, width, repeats):
+    """
+        Stages that do not need a graph, on one batch of images
+    """
+
+    batch = [images[i % len(images)] for i in range(batch_size)]
+    files = [f for f, _ in batch]
+    labels = [label for _, label in batch]
+    params = {"batch_size": batch_size, "width": width}
+
+    decoded = [np.array(Image.open(f, mode="r")) for f in files]
+    encoded = [label_to_array(label, char_vector) for label in labels]
+
+    return [
+        summarize(
+            "decode",
+            measure(lambda: [np.array(Image.open(f, mode="r")) for f in files], repeats),
+            batch_size,
+            **params
+        ),
+        summarize(
+            "resize",
+            measure(lambda: [resize_image(arr, width) for arr in decoded], repeats),
+            batch_size,
+            **params
+        ),
+        summarize(
+            "label_to_array",
+            measure(lambda: [label_to_array(label, char_vector) for label in labels], repeats),
+            batch_size,
+            **params
+        ),
+        summarize(
+            "sparse_tuple",
+            measure(lambda: sparse_tuple_from(encoded), repeats),
+            batch_size,
+            **params
+        ),
+    ]
+
+
+def benchmark_model(crnn, images, batch_size, width, repeats):
+    """
+        DataManager batching and session.run stages of a CRNN built for batch_size and width
+    """
+
+    data_manager = crnn.data_manager
+    session = crnn.session
+    params = {"batch_size": batch_size, "width": width}
+    results = []
+
+    examples = [data_manager.data[i % data_manager.data_len] for i in range(batch_size)]
+    results.append(
+        summarize(
+            "make_batch",
+            measure(lambda: data_manager.make_batch(examples), repeats),
+            batch_size,
+            **params
+        )
+    )
+
+    # Time the trainer waits for the next batch of the prefetching iterator
+    batches = [iter(data_manager.train_batches)]
+
+    def next_batch():
+        try:
+            return next(batches[0])
+        except StopIteration:
+            batches[0] = iter(data_manager.train_batches)
+            return next(batches[0])
+
+    results.append(summarize("queue_transfer", measure(next_batch, repeats), batch_size, **params))
+
+    _, batch_dt, batch_x, batch_sl = data_manager.make_batch(examples)
+    feed_dict = {
+        crnn.inputs: normalize_batch(batch_x),
+        crnn.seq_len: batch_sl,
+        crnn.targets: batch_dt,
+    }
+    results.append(
+        summarize(
+            "forward",
+            measure(lambda: session.run(crnn.logits, feed_dict=feed_dict), repeats),
+            batch_size,
+            **params
+        )
+    )
+    # Forward, backward and the Adam update
+    results.append(
+        summarize(
+            "train_step",
+            measure(
+                lambda: session.run([crnn.optimizer, crnn.cost], feed_dict=feed_dict),
+                repeats,
+            ),
+            batch_size,
+            **params
+        )
+    )
+
+    # Decoders alone, fed with the logits of the forward pass
+    logits = session.run(crnn.logits, feed_dict=feed_dict)
+    for decoder in ("greedy", "beam"):
+        decoded = session.graph.get_tensor_by_name("dense_decoded_{}:0".format(decoder))
+        results.append(
+            summarize(
+                decoder + "_decode",
+                measure(
+                    lambda: session.run(
+                        decoded, feed_dict={crnn.logits: logits, crnn.seq_len: batch_sl}
+                    ),
+                    repeats,
+                ),
+                batch_size,
+                **params
+            )
+        )
+
+    # From the image files to the decoded strings, as an inference would
+    files = [images[i % len(images)][0] for i in range(batch_size)]
+
+    def end_to_end():
+        batch = []
+        for f in files:
+            arr, w = resize_image(np.array(Image.open(f, mode="r")), width)
+            batch.append((arr, "", [], w))
+        _, _, batch_x, batch_sl = data_manager.make_batch(batch)
+        decoded = session.run(
+            crnn.decoded,
+            feed_dict={crnn.inputs: normalize_batch(batch_x), crnn.seq_len: batch_sl},
+        )
+        return crnn.charset.decode_batch(decoded)
+
+    results.append(summarize("end_to_end", measure(end_to_end, repeats), batch_size, **params))
+    return results
+
+
+def run_benchmark(
+    char_vector,
+    batch_sizes,
+    widths,
+    repeats,
+    model_path,
+    restore=False,
+    dynamic_width=False,
+    image_dirs=None,
+    output_path=None,
+    config=None,
+):
+    """
+        Run every stage for every batch size and width on the images of
+        image_dirs (samples/ and test/ by default), return the results and
+        write them as JSON to output_path if set
+    """
+
+    images = list_images(image_dirs or IMAGE_DIRS)
+    report = {
+        "config": {
+            "batch_sizes": batch_sizes,
+            "widths": widths,
+            "repeats": repeats,
+            "restore": restore,
+            "dynamic_width": dynamic_width,
+            "images": len(images),
+        },
+        "results": [],
+    }
+
+    for width in widths:
+        for batch_size in batch_sizes:
+            print("Benchmarking batch size {}, width {}".format(batch_size, width))
+            report["results"].extend(
+                benchmark_data(images, char_vector, batch_size, width, repeats)
+            )
+
+            examples_path = tempfile.mkdtemp(prefix="crnn-benchmark-")
+            try:
+                # Enough examples for a few training batches after the test split
+                write_examples(
+                    images, examples_path, 4 * batch_size, compute_seq_len(width)
+                )
+                with tf.Graph().as_default():
+                    crnn = CRNN(
+                        batch_size,
+                        model_path,
+                        examples_path,
+                        width,
+                        0.9,
+                        restore,
+                        char_vector,
+                        False,
+                        "en",
+                        0.0001,
+                        dynamic_width=dynamic_width,
+                        session_config=config,
+                    )
+                    try:
+                        report["results"].extend(
+                            benchmark_model(crnn, images, batch_size, width, repeats)
+                        )
+                    finally:
+                        crnn.data_manager.close()
+                        crnn.session.close()
+            finally:
+                shutil.rmtree(examples_path)
+
+    if output_path:
+        with open(output_path, "w") as f:
+            json.dump(report, f, indent=2)
+        print("Benchmark written to {}".format(output_path))
+    return report
+
+
+def autotune_threads(
+    frozen_model_path,
+    char_vector,
+    batch_size,
+    repeats,
+    max_image_width=None,
+    image_dirs=None,
+    output_path=None,
+    **optimizer_options
+):
+    """
+        Time Predictor.predict_batch on the frozen graph for a few intra-op and
+        inter-op thread counts, return the report and write it as JSON to
+        output_path if set. optimizer_options are passed to session_config.
+    """
+
+    images = list_images(image_dirs or IMAGE_DIRS)
+    cores = len(os.sched_getaffinity(0))
+    intra_candidates = sorted(set(n for n in (1, 2, 4, cores // 2, cores) if 0 < n <= cores))
+    inter_candidates = [1, 2]
+
+    results = []
+    for intra in intra_candidates:
+        for inter in inter_candidates:
+            print("Benchmarking {} intra-op and {} inter-op threads".format(intra, inter))
+            predictor = Predictor(
+                frozen_model_path,
+                char_vector,
+                batch_size=batch_size,
+                max_image_width=max_image_width,
+                session_config=session_config(intra, inter, **optimizer_options),
+            )
+            try:
+                examples = [
+                    predictor.preprocess(images[i % len(images)][0])
+                    for i in range(batch_size)
+                ]
+                results.append(
+                    summarize(
+                        "predict_batch",
+                        measure(lambda: predictor.predict_batch(examples), repeats),
+                        batch_size,
+                        intra_op_threads=intra,
+                        inter_op_threads=inter,
+                    )
+                )
+            finally:
+                predictor.close()
+
+    best = max(results, key=lambda r: r["images_per_second"])
+    report = {
+        "cores": cores,
+        "batch_size": batch_size,
+        "optimizer_options": optimizer_options,
+        "results": results,
+        "best": {
+            "intra_op_threads": best["intra_op_threads"],
+            "inter_op_threads": best["inter_op_threads"],
+        },
+    }
+    print(
+        "Fastest: --intra_op_threads {} --inter_op_threads {} ({:.1f} images/s)".format(
+            best["intra_op_threads"], best["inter_op_threads"], best["images_per_second"]
+        )
+    )
+
+    if output_path:
+        with open(output_path, "w") as f:
+            json.dump(report, f, indent=2)
+        print("Autotune results written to {}".format(output_path))
+    return report
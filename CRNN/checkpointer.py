@@ -0,0 +1,100 @@
+import queue
+import threading
+import tensorflow as tf
+
+
+class AsyncCheckpointer(object):
+    """
+        Writes checkpoints and frozen graphs in a background thread.
+
+        The training thread only copies the variables to numpy (one
+        session.run), the copy is then loaded in a shadow graph imported from
+        the training graph, where it is saved and frozen while training goes
+        on. At most one snapshot waits for the thread, a newer one blocks
+        until it is taken so that no checkpoint is dropped.
+    """
+
+    def __init__(self, session, saver, save_path, freeze_fn):
+        """
+            freeze_fn(session) writes a frozen graph from the shadow session
+        """
+
+        self.session = session
+        self.saver = saver
+        self.save_path = save_path
+        self.freeze_fn = freeze_fn
+
+        self.variables = None
+        self.shadow_session = None
+        self.shadow_saver = None
+        self.shadow_variables = None
+
+        self.jobs = queue.Queue(maxsize=1)
+        self.error = None
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def build_shadow(self):
+        # Imported lazily so that the ops added after the constructor are there too
+        meta_graph = tf.train.export_meta_graph(
+            graph=self.session.graph, saver_def=self.saver.saver_def
+        )
+        graph = tf.Graph()
+        with graph.as_default():
+            self.shadow_saver = tf.train.import_meta_graph(meta_graph, clear_devices=True)
+            by_name = {v.op.name: v for v in tf.global_variables()}
+        self.variables = self.session.graph.get_collection(tf.GraphKeys.GLOBAL_VARIABLES)
+        self.shadow_variables = [by_name[v.op.name] for v in self.variables]
+        self.shadow_session = tf.Session(graph=graph)
+
+    def submit(self, step, checkpoint=True, freeze=False):
+        """
+            Snapshot the variables and queue a checkpoint and/or a frozen export
+        """
+
+        if self.error is not None:
+            raise self.error
+        if not checkpoint and not freeze:
+            return
+        if self.shadow_session is None:
+            self.build_shadow()
+
+        values = self.session.run(self.variables)
+        self.jobs.put((step, values, checkpoint, freeze))
+
+    def run(self):
+        while True:
+            job = self.jobs.get()
+            try:
+                if job is None:
+                    return
+                step, values, checkpoint, freeze = job
+                for variable, value in zip(self.shadow_variables, values):
+                    variable.load(value, self.shadow_session)
+                if checkpoint:
+                    self.shadow_saver.save(
+                        self.shadow_session, self.save_path, global_step=step
+                    )
+                if freeze:
+                    self.freeze_fn(self.shadow_session)
+            except Exception as ex:
+                self.error = ex
+            finally:
+                self.jobs.task_done()
+
+    def wait(self):
+        """
+            Block until every queued snapshot is written
+        """
+
+        self.jobs.join()
+        if self.error is not None:
+            raise self.error
+
+    def close(self):
+        self.jobs.put(None)
+        self.thread.join()
+        if self.shadow_session is not None:
+            self.shadow_session.close()
+        if self.error is not None:
+            raise self.error
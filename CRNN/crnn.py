@@ -1,4 +1,5 @@
 import os
+import re
 import time
 import sys
 import datetime
@@ -6,13 +7,18 @@ import numpy as np
 import tensorflow as tf
 from tensorflow.contrib import rnn
 
+from checkpointer import AsyncCheckpointer
 from data_manager import DataManager
+from export import optimize_graph
+from profiler import StepProfiler
 from utils import (
     sparse_tuple_from,
     resize_image,
     label_to_array,
-    ground_truth_to_word,
     levenshtein,
+    normalize_batch,
+    compute_seq_len,
+    Charset,
 )
 
 os.environ["TF_CPP_MIN_LOG_LEVEL"] = "3"
@@ -30,11 +36,39 @@ class CRNN(object):
             char_set_string,
             use_trdg,
             language,
-            learning_rate
+            learning_rate,
+            shards_path=None,
+            width_buckets=None,
+            dynamic_width=False,
+            use_tf_data=False,
+            num_parallel_calls=4,
+            trdg_workers=2,
+            trdg_queue_size=20,
+            trdg_shared_memory=False,
+            trdg_cache_path=None,
+            trdg_cache_size=100000,
+            trdg_fresh_ratio=0.0,
+            load_workers=1,
+            manifest_path=None,
+            summary_interval=100,
+            checkpoint_interval=1,
+            freeze_interval=1,
+            decoder="beam",
+            beam_width=100,
+            profile_steps=None,
+            profile_dir="profile",
+            session_config=None,
+            rnn_cell="basic",
+            rnn_hidden_size=256,
+            num_workers=1,
+            rank=0,
+            all_reduce=None,
+            data_ready=None,
     ):
         tf.compat.v1.logging.set_verbosity(tf.compat.v1.logging.ERROR)
         self.step = 0
         self.CHAR_VECTOR = char_set_string
+        self.charset = Charset(self.CHAR_VECTOR)
         self.NUM_CLASSES = len(self.CHAR_VECTOR) + 1
         # print("CHAR_VECTOR {}".format(self.CHAR_VECTOR))
         print("NUM_CLASSES {}".format(self.NUM_CLASSES))
@@ -46,9 +80,74 @@ class CRNN(object):
         print("Learning Rate {}".format(self.learning_rate))
 
         self.restore = restore
+        for name, interval in (
+            ("summary_interval", summary_interval),
+            ("checkpoint_interval", checkpoint_interval),
+            ("freeze_interval", freeze_interval),
+        ):
+            if interval < 1:
+                raise ValueError("{} must be at least 1, not {}".format(name, interval))
+        self.summary_interval = summary_interval
+        self.checkpoint_interval = checkpoint_interval
+        self.freeze_interval = freeze_interval
+        self.dynamic_width = dynamic_width
+        if decoder not in ("greedy", "beam"):
+            raise ValueError("Unknown decoder {}, use greedy or beam".format(decoder))
+        self.decoder = decoder
+        self.beam_width = beam_width
+        if rnn_cell not in ("basic", "fused"):
+            raise ValueError("Unknown rnn_cell {}, use basic or fused".format(rnn_cell))
+        self.rnn_cell = rnn_cell
+        self.rnn_hidden_size = rnn_hidden_size
+        # Data-parallel training (see distributed.py), only rank 0 writes
+        # checkpoints, summaries and frozen graphs
+        self.all_reduce = all_reduce
+        self.num_workers = num_workers
+        self.is_chief = rank == 0
+        # Traced session.run calls, train steps and test batches alike. Like
+        # the summaries, only rank 0 writes them, to the same profile_dir
+        self.profiler = None
+        if profile_steps and self.is_chief:
+            self.profiler = StepProfiler(profile_steps, profile_dir)
         self.train_log_dir = "tensorboard/train/"
         self.training_name = str(int(time.time()))
-        self.session = tf.Session()
+
+        # Creating data_manager, which forks its worker processes before the
+        # session starts the TensorFlow thread pools
+        self.data_manager = DataManager(
+            batch_size,
+            model_path,
+            examples_path,
+            max_image_width,
+            train_test_ratio,
+            compute_seq_len(max_image_width),
+            self.CHAR_VECTOR,
+            use_trdg,
+            language,
+            shards_path,
+            width_buckets=width_buckets,
+            dynamic_width=dynamic_width,
+            use_tf_data=use_tf_data,
+            num_workers=trdg_workers,
+            queue_size=trdg_queue_size,
+            shared_memory=trdg_shared_memory,
+            trdg_cache_path=trdg_cache_path,
+            trdg_cache_size=trdg_cache_size,
+            trdg_fresh_ratio=trdg_fresh_ratio,
+            load_workers=load_workers,
+            manifest_path=manifest_path,
+            shard_index=rank,
+            num_shards=num_workers,
+            data_ready=data_ready,
+        )
+        self.session = tf.Session(config=session_config)
+
+        # The graph reads its batches from this pipeline unless they are fed
+        self.dataset = None
+        if use_tf_data:
+            self.dataset = self.data_manager.train_dataset(
+                num_parallel_calls, prefetch=2
+            )
 
         # Building graph
         with self.session.as_default():
@@ -63,7 +162,8 @@ class CRNN(object):
                 self.cost,
                 self.max_char_count,
                 self.init,
-                self.weight_matrix
+                self.weight_matrix,
+                self.confidence,
             ) = self.crnn(max_image_width)
             self.init.run()
         with self.session.as_default():
@@ -74,8 +174,10 @@ class CRNN(object):
             #       tf.compat.v1.trainable_variables(scope="batch"),
             #       "\n",
             #   tf.compat.v1.trainable_variables())
-            self.train_summary_writer = tf.summary.FileWriter(
-                self.train_log_dir, tf.get_default_session().graph)
+            self.train_summary_writer = None
+            if self.is_chief:
+                self.train_summary_writer = tf.summary.FileWriter(
+                    self.train_log_dir, tf.get_default_session().graph)
             self.saver = tf.train.Saver(tf.global_variables(), max_to_keep=10)
             # Loading last save if needed
             if self.restore:
@@ -87,43 +189,42 @@ class CRNN(object):
                     self.step = int(ckpt.split("-")[1])
                     self.saver.restore(self.session, ckpt)
 
-        # Creating data_manager
-        self.data_manager = DataManager(
-            batch_size,
-            model_path,
-            examples_path,
-            max_image_width,
-            train_test_ratio,
-            self.max_char_count,
-            self.CHAR_VECTOR,
-            use_trdg,
-            language,
-        )
+            # Every data-parallel worker starts from the weights of rank 0
+            if self.all_reduce is not None:
+                variables = tf.trainable_variables()
+                values = self.all_reduce.broadcast(self.session.run(variables))
+                for variable, value in zip(variables, values):
+                    variable.load(value, self.session)
 
     def crnn(self, max_width):
+        hidden_size = self.rnn_hidden_size
+
         def BidirectionnalRNN(inputs, seq_len):
             """
                 Bidirectionnal LSTM Recurrent Neural Network part
             """
 
+            if self.rnn_cell == "fused":
+                return FusedBidirectionnalRNN(inputs, seq_len)
+
             with tf.variable_scope(None, default_name="bidirectional-rnn-1"):
                 # Forward
-                lstm_fw_cell_1 = rnn.BasicLSTMCell(256)
+                lstm_fw_cell_1 = rnn.BasicLSTMCell(hidden_size)
                 # Backward
-                lstm_bw_cell_1 = rnn.BasicLSTMCell(256)
+                lstm_bw_cell_1 = rnn.BasicLSTMCell(hidden_size)
 
                 inter_output, _ = tf.nn.bidirectional_dynamic_rnn(
                     lstm_fw_cell_1, lstm_bw_cell_1, inputs, seq_len, dtype=tf.float32
-                )  # shape: ([batch_size, max_time, 256], [batch_size, max_time, 256])
+                )  # shape: ([batch_size, max_time, hidden_size], [batch_size, max_time, hidden_size])
 
-                # shape: [batch_size, max_time, 512]
+                # shape: [batch_size, max_time, 2 * hidden_size]
                 inter_output = tf.concat(inter_output, 2)
 
             with tf.variable_scope(None, default_name="bidirectional-rnn-2"):
                 # Forward
-                lstm_fw_cell_2 = rnn.BasicLSTMCell(256)
+                lstm_fw_cell_2 = rnn.BasicLSTMCell(hidden_size)
                 # Backward
-                lstm_bw_cell_2 = rnn.BasicLSTMCell(256)
+                lstm_bw_cell_2 = rnn.BasicLSTMCell(hidden_size)
 
                 outputs, _ = tf.nn.bidirectional_dynamic_rnn(
                     lstm_fw_cell_2,
@@ -131,13 +232,44 @@ class CRNN(object):
                     inter_output,
                     seq_len,
                     dtype=tf.float32,
-                )  # shape: ([batch_size, max_time, 256], [batch_size, max_time, 256])
+                )  # shape: ([batch_size, max_time, hidden_size], [batch_size, max_time, hidden_size])
 
                 outputs = tf.concat(outputs, 2)
-                # shape: [batch_size, max_time, 512]
+                # shape: [batch_size, max_time, 2 * hidden_size]
 
             return outputs
 
+        def FusedBidirectionnalRNN(inputs, seq_len):
+            """
+                Same layers with one fused time-major kernel per direction
+                instead of a while loop, see convert_checkpoint for the weights
+            """
+
+            # shape: [max_time, batch_size, 512]
+            outputs = tf.transpose(inputs, (1, 0, 2))
+            # The cells are named like BasicLSTMCell's, instead of the
+            # default lstm_fused_cell, to match RNN_VARIABLE_PATTERNS
+            for name in ("bidirectional-rnn-1", "bidirectional-rnn-2"):
+                with tf.variable_scope(None, default_name=name):
+                    with tf.variable_scope("fw"):
+                        fw_outputs, _ = rnn.LSTMBlockFusedCell(hidden_size, name="lstm_cell")(
+                            outputs, dtype=tf.float32, sequence_length=seq_len
+                        )
+                    with tf.variable_scope("bw"):
+                        # The backward pass runs on the reversed valid steps
+                        bw_outputs, _ = rnn.LSTMBlockFusedCell(hidden_size, name="lstm_cell")(
+                            tf.reverse_sequence(outputs, seq_len, seq_axis=0, batch_axis=1),
+                            dtype=tf.float32,
+                            sequence_length=seq_len,
+                        )
+                        bw_outputs = tf.reverse_sequence(
+                            bw_outputs, seq_len, seq_axis=0, batch_axis=1
+                        )
+                    # shape: [max_time, batch_size, 2 * hidden_size]
+                    outputs = tf.concat([fw_outputs, bw_outputs], 2)
+
+            return tf.transpose(outputs, (1, 0, 2))
+
         def CNN(inputs):
             """
                 Convolutionnal Neural Network part
@@ -233,15 +365,46 @@ class CRNN(object):
             return conv7  # shape: (batch_size, H, 1, 512)
 
         batch_size = None
-        inputs = tf.placeholder(
-            tf.float32, [batch_size, max_width, 32, 1], name="input"
-        )
+        # A dynamic width lets the exported graph run on any width, the CNN
+        # and the BiLSTM then only cost as much as the actual batch width
+        input_shape = [batch_size, None if self.dynamic_width else max_width, 32, 1]
 
-        # Our target output
-        targets = tf.sparse_placeholder(tf.int32, name="targets")
+        if self.dataset is None:
+            inputs = tf.placeholder(tf.float32, input_shape, name="input")
 
-        # The length of the sequence
-        seq_len = tf.placeholder(tf.int32, [None], name="seq_len")
+            # Our target output
+            targets = tf.sparse_placeholder(tf.int32, name="targets")
+
+            # The length of the sequence
+            seq_len = tf.placeholder(tf.int32, [None], name="seq_len")
+        else:
+            # Same nodes, but defaulting to the tf.data iterator outputs so that
+            # training needs no feed_dict while test can still feed them
+            (
+                images,
+                target_indices,
+                target_values,
+                target_shape,
+                batch_seq_len,
+            ) = self.dataset.make_one_shot_iterator().get_next()
+
+            inputs = tf.placeholder_with_default(
+                tf.cast(images, tf.float32) / 255.0, input_shape, name="input"
+            )
+            targets = tf.SparseTensor(
+                tf.placeholder_with_default(
+                    target_indices, [None, 2], name="targets/indices"
+                ),
+                tf.placeholder_with_default(
+                    target_values, [None], name="targets/values"
+                ),
+                tf.placeholder_with_default(
+                    target_shape, [2], name="targets/shape"
+                ),
+            )
+            seq_len = tf.placeholder_with_default(
+                batch_seq_len, [None], name="seq_len"
+            )
 
         # feature map shape: (batch_size, max_time, 1, 512)
         cnn_output = CNN(inputs)
@@ -251,24 +414,32 @@ class CRNN(object):
         tf.summary.image("cnn output", tf.expand_dims(
             reshaped_cnn_output, -1), max_outputs=3)
 
-        max_char_count = cnn_output.get_shape().as_list()[
-            1]  # shape: (max_time)
+        if self.dynamic_width:
+            max_char_count = compute_seq_len(max_width)
+            time_steps = tf.shape(cnn_output)[1]
+        else:
+            max_char_count = cnn_output.get_shape().as_list()[
+                1]  # shape: (max_time)
+            time_steps = max_char_count
 
         crnn_model = BidirectionnalRNN(reshaped_cnn_output, seq_len)
 
-        logits = tf.reshape(crnn_model, [-1, 512])
+        logits = tf.reshape(crnn_model, [-1, 2 * hidden_size])
         W = tf.Variable(
-            tf.truncated_normal([512, self.NUM_CLASSES], stddev=0.1), name="W"
+            tf.truncated_normal([2 * hidden_size, self.NUM_CLASSES], stddev=0.1), name="W"
         )
         b = tf.Variable(tf.constant(0.0, shape=[self.NUM_CLASSES]), name="b")
 
         logits = tf.matmul(logits, W) + b  # shape: [, NUM_CLASSES]
         logits = tf.reshape(
-            logits, [tf.shape(cnn_output)[0], max_char_count, self.NUM_CLASSES]
+            logits, [tf.shape(cnn_output)[0], time_steps, self.NUM_CLASSES]
         )  # shape: [batch_size, max_time, NUM_CLASSES]
 
         # Final layer, the output of the BLSTM
-        logits = tf.transpose(logits, (1, 0, 2))  # shape: [H, W, NUM_CLASSES]
+        # Named so that the decoders can be run alone by feeding it
+        logits = tf.identity(
+            tf.transpose(logits, (1, 0, 2)), name="logits"
+        )  # shape: [H, W, NUM_CLASSES]
 
         # Loss and cost calculation
         # shapes -
@@ -285,20 +456,55 @@ class CRNN(object):
         # Training step
         optimizer = tf.train.AdamOptimizer(learning_rate=self.learning_rate)
 
-        optimizer = optimizer.minimize(cost)
+        if self.all_reduce is None:
+            optimizer = optimizer.minimize(cost)
+        else:
+            # The gradients are averaged across the workers before being fed back
+            gradients, variables = zip(*optimizer.compute_gradients(cost))
+            self.gradients = list(gradients)
+            self.averaged_gradients = [
+                tf.placeholder(tf.float32, v.get_shape()) for v in variables
+            ]
+            optimizer = optimizer.apply_gradients(
+                zip(self.averaged_gradients, variables)
+            )
 
         # The decoded answer
         # shapes:
         # decoded: [top_path_decoded_list]
         # decode[i]: [batch_size, max_decoded_length]
         # log_prob: [batch_size, top_paths]
-        decoded, log_prob = tf.nn.ctc_beam_search_decoder(
-            logits, seq_len, merge_repeated=False
+        greedy_decoded, beam_decoded, log_prob = ctc_decoders(
+            logits, seq_len, self.beam_width
         )
 
-        dense_decoded = tf.sparse_tensor_to_dense(
-            decoded[0], default_value=-1, name="dense_decoded"
+        # Both decoders are exported, dense_decoded is the one selected by decoder
+        dense_decoded_greedy = tf.sparse_tensor_to_dense(
+            greedy_decoded[0], default_value=-1, name="dense_decoded_greedy"
         )  # shape: [batch_size, max_decoded_length]
+        dense_decoded_beam = tf.sparse_tensor_to_dense(
+            beam_decoded[0], default_value=-1, name="dense_decoded_beam"
+        )
+
+        # Probability of the decoded sequence, the greedy one is the product of
+        # the best class probabilities over the first seq_len steps
+        step_mask = tf.transpose(
+            tf.sequence_mask(seq_len, tf.shape(logits)[0], dtype=tf.float32)
+        )
+        best_log_probs = tf.reduce_max(tf.nn.log_softmax(logits), axis=2)
+        confidence_greedy = tf.exp(
+            tf.reduce_sum(best_log_probs * step_mask, axis=0), name="confidence_greedy"
+        )  # shape: [batch_size]
+        confidence_beam = tf.exp(log_prob[:, 0], name="confidence_beam")
+
+        if self.decoder == "greedy":
+            decoded = greedy_decoded
+            dense_decoded = tf.identity(dense_decoded_greedy, name="dense_decoded")
+            confidence = tf.identity(confidence_greedy, name="confidence")
+        else:
+            decoded = beam_decoded
+            dense_decoded = tf.identity(dense_decoded_beam, name="dense_decoded")
+            confidence = tf.identity(confidence_beam, name="confidence")
 
         # The error rate
         acc = tf.reduce_mean(tf.edit_distance(
@@ -318,77 +524,168 @@ class CRNN(object):
             max_char_count,
             init,
             W,
+            confidence,
+        )
+
+    def train_batches(self):
+        """
+            Yield (batch_y, feed_dict) pairs, batch_y is None when the graph
+            reads its batches from tf.data
+        """
+
+        if self.dataset is not None:
+            while True:
+                yield None, {}
+
+        # DataManager checked that every shard has at least one batch
+        while True:
+            for batch_y, batch_dt, batch_x, batch_sl in self.data_manager.train_batches:
+                yield batch_y, {
+                    self.inputs: normalize_batch(batch_x),
+                    self.seq_len: batch_sl,
+                    self.targets: batch_dt,
+                }
+            # Data-parallel workers must all run the same number of steps,
+            # whatever the number of batches of their shard
+            if self.all_reduce is None:
+                return
+
+    def run_train_step(self, fetches, feed_dict, run_kwargs):
+        """
+            session.run of the optimizer and fetches, return the fetched values.
+            In data-parallel mode the gradients are averaged across the workers
+            and applied by a second session.run.
+        """
+
+        if self.all_reduce is None:
+            return self.session.run(
+                [self.optimizer] + fetches, feed_dict=feed_dict, **run_kwargs
+            )[1:]
+
+        results = self.session.run(
+            self.gradients + fetches, feed_dict=feed_dict, **run_kwargs
+        )
+        gradients = self.all_reduce.mean(results[: len(self.gradients)])
+        self.session.run(
+            self.optimizer, feed_dict=dict(zip(self.averaged_gradients, gradients))
         )
+        return results[len(self.gradients):]
 
     def train(self, iteration_count):
         with self.session.as_default():
             print("Training")
             self.max_weight = tf.math.reduce_max(self.weight_matrix)
+            ground_truth = tf.sparse_tensor_to_dense(self.targets, default_value=-1)
             merged = tf.summary.merge_all()
+            checkpointer = None
+            if self.is_chief:
+                checkpointer = AsyncCheckpointer(
+                    self.session,
+                    self.saver,
+                    self.save_path,
+                    lambda session: self.save_frozen_model("save/frozen.pb", session=session),
+                )
 
+            last_iteration = iteration_count + self.step - 1
+            # Counted across iterations, every summary_interval-th step (the
+            # first one included) decodes and writes summaries
+            train_step = 0
+            acc = max_weight = None
             for i in range(self.step, iteration_count + self.step):
                 print("Processing iteration ::", i)
                 batch_count = 0
                 iter_loss = 0
+                iter_start = time.time()
+
+                for batch_y, feed_dict in self.train_batches():
+                    run_kwargs = self.profiler.run_kwargs(train_step) if self.profiler else {}
+
+                    if train_step % self.summary_interval != 0 or not self.is_chief:
+                        # Lean step, without beam search, edit distance and summaries
+                        loss_value, = self.run_train_step(
+                            [self.cost], feed_dict, run_kwargs
+                        )
+                    else:
+                        fetches = [self.decoded, self.cost,
+                                   self.acc, self.max_weight, merged]
+                        if batch_y is None:
+                            fetches.append(ground_truth)
+
+                        results = self.run_train_step(fetches, feed_dict, run_kwargs)
+                        decoded, loss_value, acc, max_weight, summary = results[:5]
+                        if batch_y is None:
+                            batch_y = self.charset.decode_batch(results[5])
+                        self.train_summary_writer.add_summary(summary, self.step)
 
-                for batch_y, batch_dt, batch_x in self.data_manager.train_batches:
-                    op, decoded, loss_value, acc, max_weight, summary = self.session.run(
-                        [self.optimizer, self.decoded, self.cost,
-                            self.acc, self.max_weight, merged],
-                        feed_dict={
-                            self.inputs: batch_x,
-                            self.seq_len: [self.max_char_count]
-                            * self.data_manager.batch_size,
-                            self.targets: batch_dt,
-                        },
-                    )
-                    self.train_summary_writer.add_summary(summary, self.step)
-
-                    if i % 1 == 0:
                         for j in range(2):
                             print(f"decoded ...{decoded[0]}")
-                            pred = ground_truth_to_word(
-                                decoded[j], self.CHAR_VECTOR)
+                            pred = self.charset.decode(decoded[j])
                             print("{} | {}".format(batch_y[j], pred))
                         print("---- {} | {} ----".format(i, batch_count))
 
+                    if run_kwargs:
+                        self.profiler.record("train", train_step, run_kwargs)
+                    train_step += 1
+
                     iter_loss += loss_value
                     batch_count += 1
                     if batch_count >= 100:
                         break
 
-                self.saver.save(self.session, self.save_path,
-                                global_step=self.step)
-
+                elapsed = time.time() - iter_start
+                if not self.is_chief:
+                    print("[{}] Worker iteration loss: {}".format(self.step, iter_loss))
+                    self.step += 1
+                    continue
+
+                # Saved and frozen in the background, the last iteration always is
+                checkpointer.submit(
+                    self.step,
+                    checkpoint=(i + 1) % self.checkpoint_interval == 0 or i == last_iteration,
+                    freeze=(i + 1) % self.freeze_interval == 0 or i == last_iteration,
+                )
                 self.train_summary_writer.flush()
-                self.save_frozen_model("save/frozen.pb")
 
                 print("[{}] Iteration loss: {} Error rate: {}".format(
                     self.step, iter_loss, acc))
+                print("{:.1f} images/s".format(
+                    batch_count * self.data_manager.batch_size * self.num_workers / elapsed))
 
                 print("max weight", max_weight)
+                if self.data_manager.worker_pool is not None:
+                    print("TRDG workers", self.data_manager.worker_pool.stats())
                 self.step += 1
-            self.train_summary_writer.close()
+            if self.is_chief:
+                checkpointer.close()
+                self.train_summary_writer.close()
+            if self.profiler:
+                self.profiler.close()
         return None
 
     def test(self):
         with self.session.as_default():
             print("Testing")
-            for batch_y, _, batch_x in self.data_manager.test_batches:
-                decoded = self.session.run(
-                    self.decoded,
+            for batch_index, (batch_y, _, batch_x, batch_sl) in enumerate(
+                    self.data_manager.test_batches):
+                run_kwargs = self.profiler.run_kwargs(batch_index) if self.profiler else {}
+                decoded, confidence = self.session.run(
+                    [self.decoded, self.confidence],
                     feed_dict={
-                        self.inputs: batch_x,
-                        self.seq_len: [self.max_char_count]
-                        * self.data_manager.batch_size,
+                        self.inputs: normalize_batch(batch_x),
+                        self.seq_len: batch_sl,
                     },
+                    **run_kwargs
                 )
+                if run_kwargs:
+                    self.profiler.record("test", batch_index, run_kwargs)
 
                 for i, y in enumerate(batch_y):
                     print("Ground truth", batch_y[i])
                     print(f"decode batch:{i}", decoded.shape)
-                    print("Test result", ground_truth_to_word(
-                        decoded[i], self.CHAR_VECTOR))
+                    print("Test result", self.charset.decode(decoded[i]))
+                    print("Confidence", confidence[i])
+            if self.profiler:
+                self.profiler.close()
         return None
 
     def save_frozen_model(
@@ -396,31 +693,136 @@ class CRNN(object):
             path=None,
             optimize=False,
             input_nodes=["input", "seq_len"],
-            output_nodes=["dense_decoded"],
+            output_nodes=[
+                "dense_decoded",
+                "dense_decoded_greedy",
+                "dense_decoded_beam",
+                "confidence",
+                "confidence_greedy",
+                "confidence_beam",
+            ],
+            session=None,
+            decoder=None,
+            beam_width=None,
     ):
+        """
+            session defaults to the training session, AsyncCheckpointer passes
+            its shadow session holding a snapshot of the variables.
+
+            decoder ("greedy" or "beam") and beam_width override the ones the
+            graph was built with in the exported dense_decoded node
+        """
+
         if not path or len(path) == 0:
             raise ValueError("Save path for frozen model is not specified")
+        session = session or self.session
 
         tf.train.write_graph(
-            self.session.graph_def,
+            session.graph_def,
             "/".join(path.split("/")[0:-1]),
             path.split("/")[-1] + ".pbtxt",
         )
 
         # get graph definitions with weights
         output_graph_def = tf.graph_util.convert_variables_to_constants(
-            self.session,  # The session is used to retrieve the weights
-            self.session.graph.as_graph_def(),  # The graph_def is used to retrieve the nodes
+            session,  # The session is used to retrieve the weights
+            session.graph.as_graph_def(),  # The graph_def is used to retrieve the nodes
             output_nodes,  # The output node names are used to select the usefull nodes
         )
 
+        # With tf.data the inputs default to the iterator outputs, the exported
+        # graph gets plain placeholders and loses the input pipeline instead
+        if self.dataset is not None:
+            for node in output_graph_def.node:
+                if node.name in input_nodes and node.op == "PlaceholderWithDefault":
+                    node.op = "Placeholder"
+                    del node.input[:]
+            output_graph_def = tf.graph_util.extract_sub_graph(
+                output_graph_def, output_nodes
+            )
+            output_graph_def.library.Clear()
+
+        for node in output_graph_def.node:
+            if decoder and node.name in ("dense_decoded", "confidence"):
+                node.input[0] = node.name + "_" + decoder
+            if beam_width and node.op == "CTCBeamSearchDecoder":
+                node.attr["beam_width"].i = beam_width
+
         # optimize graph
         if optimize:
-            output_graph_def = optimize_for_inference_lib.optimize_for_inference(
-                output_graph_def, input_nodes, output_nodes, tf.float32.as_datatype_enum
+            output_graph_def = optimize_graph(
+                output_graph_def, input_nodes, output_nodes + ["logits"]
             )
 
         with open(path, "wb") as f:
             f.write(output_graph_def.SerializeToString())
 
         return True
+
+
+def ctc_decoders(logits, seq_len, beam_width):
+    """
+        Greedy and beam search decoding of time-major logits, both collapse
+        the labels the CTC way: repeats are merged unless a blank separates
+        them ("aa-a" -> "aa").
+
+        merge_repeated does not mean the same for the two ops. The greedy
+        decoder needs True to merge the repeats of the best path. The beam
+        search already merges them while extending its prefixes, True
+        would also merge the repeated letters of the output ("ll" -> "l").
+
+        return: greedy decoded, beam decoded and beam log probabilities
+    """
+
+    greedy_decoded, _ = tf.nn.ctc_greedy_decoder(logits, seq_len, merge_repeated=True)
+    beam_decoded, log_prob = tf.nn.ctc_beam_search_decoder(
+        logits, seq_len, beam_width=beam_width, merge_repeated=False
+    )
+    return greedy_decoded, beam_decoded, log_prob
+
+
+# Variable names of the LSTM weights (Adam slots included) for each rnn_cell
+RNN_VARIABLE_PATTERNS = {
+    "basic": (
+        r"(bidirectional-rnn-\d+)/bidirectional_rnn/(fw|bw)/basic_lstm_cell/",
+        r"\1/bidirectional_rnn/\2/basic_lstm_cell/",
+    ),
+    "fused": (
+        r"(bidirectional-rnn-\d+)/(fw|bw)/lstm_cell/",
+        r"\1/\2/lstm_cell/",
+    ),
+}
+
+
+def convert_checkpoint(model_path, output_path, rnn_cell):
+    """
+        Copy the latest checkpoint of model_path to output_path with the LSTM
+        variables renamed for rnn_cell ("basic" or "fused"). Both cells share
+        the same kernel layout and gate order, so only the names change.
+    """
+
+    ckpt = tf.train.latest_checkpoint(model_path)
+    if not ckpt:
+        raise Exception("No checkpoint in {}".format(model_path))
+
+    source = RNN_VARIABLE_PATTERNS["fused" if rnn_cell == "basic" else "basic"][0]
+    target = RNN_VARIABLE_PATTERNS[rnn_cell][1]
+
+    with tf.Graph().as_default(), tf.Session() as session:
+        variables = []
+        for name, _ in tf.train.list_variables(ckpt):
+            new_name = re.sub(source, target, name)
+            if new_name != name:
+                print("{} -> {}".format(name, new_name))
+            variables.append(
+                tf.Variable(tf.train.load_variable(ckpt, name), name=new_name)
+            )
+        session.run(tf.global_variables_initializer())
+
+        os.makedirs(output_path, exist_ok=True)
+        # Same step so that CRNN resumes the iteration count
+        tf.train.Saver(variables).save(
+            session,
+            os.path.join(output_path, "ckp"),
+            global_step=int(ckpt.split("-")[-1]),
+        )
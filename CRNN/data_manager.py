@@ -1,13 +1,166 @@
 import re
 import os
+import time
+import queue
+import random
+import json
+import shutil
+import hashlib
+import functools
+import itertools
+import threading
 import numpy as np
 import tensorflow as tf
-from multiprocessing import Queue, Process
-from utils import sparse_tuple_from, resize_image, label_to_array
+from multiprocessing import Pool, Process
+from utils import (
+    sparse_tuple_from,
+    resize_image,
+    compute_batch_width,
+    compute_seq_len,
+    compute_sample_seq_len,
+    Charset,
+)
+from shards import (
+    ShardDataset,
+    SHARD_INDEX,
+    label_length,
+    load_example,
+    read_shard,
+    shard_row,
+    write_shard,
+    write_index,
+)
+from worker_pool import WorkerPool, SharedMemoryRing
 
-from PIL import Image
 from trdg.generators import GeneratorFromDict
 
+MANIFEST = "manifest.json"
+
+
+class BatchIterator(object):
+    """
+        Iterable over the batches of data_manager.data[start:end].
+
+        Every iteration is a new epoch: indices are reshuffled if needed and the
+        batches are built on demand by a background thread, with at most
+        prefetch of them waiting to be consumed. With num_shards, only every
+        num_shards-th example starting at shard_index is used.
+    """
+
+    def __init__(self, data_manager, start, end, shuffle, prefetch, shard_index=0, num_shards=1):
+        self.data_manager = data_manager
+        self.start = start
+        self.end = end
+        self.shuffle = shuffle
+        self.prefetch = prefetch
+        self.shard_index = shard_index
+        self.num_shards = num_shards
+
+    def indices(self):
+        return np.arange(self.start, self.end)[self.shard_index::self.num_shards]
+
+    def __len__(self):
+        return len(self.batch_indices(self.indices()))
+
+    def batch_indices(self, indices):
+        """
+            Split indices in batches, each one holding a single width bucket
+        """
+
+        batch_size = self.data_manager.batch_size
+        groups = [indices]
+        if (
+            self.data_manager.width_buckets
+            and self.data_manager.widths is not None
+        ):
+            buckets = self.data_manager.bucket_of(self.data_manager.widths[indices])
+            groups = [
+                indices[buckets == b] for b in range(len(self.data_manager.width_buckets))
+            ]
+
+        batches = []
+        for group in groups:
+            for i in range(len(group) // batch_size):
+                batches.append(group[i * batch_size: (i + 1) * batch_size])
+
+        if self.shuffle and len(groups) > 1:
+            batches = [batches[i] for i in np.random.permutation(len(batches))]
+        return batches
+
+    def produce(self, batch_indices, batches, stop):
+        def put(item):
+            while not stop.is_set():
+                try:
+                    batches.put(item, timeout=0.1)
+                    return
+                except queue.Full:
+                    continue
+
+        # Always ends with a (None, exception) sentinel, the consumer would
+        # wait forever otherwise
+        error = None
+        try:
+            data = self.data_manager.data
+            for indices in batch_indices:
+                if stop.is_set():
+                    return
+                # The unreadable files of a DirectoryDataset are skipped
+                examples = [data[j] for j in indices]
+                examples = [example for example in examples if example is not None]
+                if examples:
+                    put((self.data_manager.make_batch(examples), None))
+        except Exception as ex:
+            error = ex
+        finally:
+            put((None, error))
+
+    def __iter__(self):
+        indices = self.indices()
+        if self.shuffle:
+            np.random.shuffle(indices)
+
+        batches = queue.Queue(maxsize=self.prefetch)
+        stop = threading.Event()
+        thread = threading.Thread(
+            target=self.produce,
+            args=(self.batch_indices(indices), batches, stop),
+            daemon=True,
+        )
+        thread.start()
+        try:
+            while True:
+                batch, error = batches.get()
+                if error is not None:
+                    raise error
+                if batch is None:
+                    return
+                yield batch
+        finally:
+            # The consumer may stop early (CRNN.train breaks after 100 batches)
+            stop.set()
+
+
+class DirectoryDataset(object):
+    """
+        Lazy view over the files of examples_path, each one is only decoded
+        when indexed. Unreadable files are indexed as None.
+    """
+
+    def __init__(self, examples_path, files, max_image_width, char_vector):
+        self.examples_path = examples_path
+        self.files = files
+        self.max_image_width = max_image_width
+        self.char_vector = char_vector
+
+    def __len__(self):
+        return len(self.files)
+
+    def __getitem__(self, i):
+        _, example = load_example(
+            self.files[i], self.examples_path, self.max_image_width, self.char_vector
+        )
+        return example
+
 
 class DataManager(object):
     def __init__(
@@ -21,180 +174,784 @@ class DataManager(object):
         char_vector,
         use_trdg,
         language,
+        shards_path=None,
+        prefetch=2,
+        width_buckets=None,
+        dynamic_width=False,
+        use_tf_data=False,
+        num_workers=2,
+        queue_size=20,
+        shared_memory=False,
+        trdg_cache_path=None,
+        trdg_cache_size=100000,
+        trdg_fresh_ratio=0.0,
+        load_workers=1,
+        load_chunk_size=64,
+        manifest_path=None,
+        shard_index=0,
+        num_shards=1,
+        data_ready=None,
     ):
+        """
+            shard_index and num_shards split the training examples between
+            data-parallel workers, each TRDG worker pool renders its own stream.
+            With data_ready, an Event shared by the workers, only shard_index 0
+            refreshes the manifest or TRDG cache and sets it, the others wait
+            and read it.
+
+            Every worker process (TRDG, cache renderers, load_workers) is forked
+            here, create the DataManager before any TensorFlow session.
+        """
+
         if train_test_ratio > 1.0 or train_test_ratio < 0:
             raise Exception("Incoherent ratio!")
 
         self.char_vector = char_vector
+        self.charset = Charset(char_vector)
 
         self.train_test_ratio = train_test_ratio
         self.max_image_width = max_image_width
         self.batch_size = batch_size
         self.model_path = model_path
-        self.current_train_offset = 0
         self.examples_path = examples_path
         self.max_char_count = max_char_count
         self.use_trdg = use_trdg
         self.language = language
-
+        self.shards_path = shards_path
+        self.dynamic_width = dynamic_width
+        self.use_tf_data = use_tf_data
+        self.trdg_cache_path = trdg_cache_path
+        self.trdg_cache_size = trdg_cache_size
+        self.trdg_fresh_ratio = trdg_fresh_ratio
+        self.load_workers = load_workers
+        self.load_chunk_size = load_chunk_size
+        self.manifest_path = manifest_path
+        self.shard_index = shard_index
+        self.num_shards = num_shards
+        self.data_ready = data_ready
+
+        # Samples are grouped by the smallest bucket holding their width
+        self.width_buckets = None
+        if width_buckets:
+            self.width_buckets = sorted(
+                set(w for w in width_buckets if w < max_image_width)
+            ) + [max_image_width]
+
+        self.worker_pool = None
         if self.use_trdg:
-            self.train_batches = self.multiprocess_batch_generator()
-            self.test_batches = self.multiprocess_batch_generator()
+            self.trdg_cache = None
+            if self.trdg_cache_path and self.data_ready is not None and shard_index != 0:
+                self.data_ready.wait()
+                self.trdg_cache = self.trdg_cache_dir()
+            elif self.trdg_cache_path:
+                self.trdg_cache = self.build_trdg_cache(num_workers)
+                if self.data_ready is not None:
+                    self.data_ready.set()
+
+            # Train and test batches come from the same stream of rendered samples
+            ring = None
+            if shared_memory:
+                ring = SharedMemoryRing(
+                    queue_size, batch_size, max_image_width, max_char_count
+                )
+            self.worker_pool = WorkerPool(
+                self.batch_generator, num_workers, queue_size, ring
+            )
+            self.worker_pool.start()
+            self.train_batches = self.worker_pool
+            self.test_batches = self.worker_pool
         else:
-            self.data, self.data_len = self.load_data()
+            if self.shards_path:
+                self.data, self.data_len = self.load_shards()
+                self.widths = self.data.widths
+            elif self.manifest_path:
+                self.data, self.data_len = self.load_manifest()
+                self.widths = self.data.widths
+            elif self.use_tf_data:
+                # Decoding is left to the tf.data map stages
+                self.data, self.data_len = self.list_data()
+                self.widths = None
+            else:
+                self.data, self.data_len = self.load_data()
+                self.widths = np.array([example[3] for example in self.data])
             self.test_offset = int(train_test_ratio * self.data_len)
-            self.current_test_offset = self.test_offset
-            self.train_batches = self.generate_all_train_batches()
-            self.test_batches = self.generate_all_test_batches()
+            self.train_batches = BatchIterator(
+                self,
+                0,
+                self.test_offset,
+                shuffle=True,
+                prefetch=prefetch,
+                shard_index=shard_index,
+                num_shards=num_shards,
+            )
+            self.test_batches = BatchIterator(
+                self, self.test_offset, self.data_len, shuffle=False, prefetch=prefetch
+            )
+            # Data-parallel workers wait for each other at every step, one
+            # without a single batch would keep the others waiting forever
+            for s in range(num_shards):
+                shard = BatchIterator(self, 0, self.test_offset, False, prefetch, s, num_shards)
+                if len(shard) == 0:
+                    raise Exception(
+                        "Error: Training data of worker {} of {} less than batch size".format(
+                            s, num_shards
+                        )
+                    )
 
-    def batch_generator(self, queue):
-        """Takes a queue and enqueue batches in it
+    def render_examples(self):
+        """Renders TRDG samples and yields (img_arr, label_string, width) tuples
         """
 
         generator = GeneratorFromDict(language=self.language)
         while True:
+            img, lbl = generator.next()
+            if not self.charset.contains(lbl):
+                continue
+            if len(self.charset.clean(lbl)) > self.max_char_count:
+                continue
+            arr, width = resize_image(np.array(img.convert("L")), self.max_image_width)
+            yield arr, lbl, width
+
+    def trdg_cache_dir(self):
+        """The cache directory of the current language, charset and image width
+        """
+
+        key = hashlib.sha1(
+            "{}\n{}\n{}".format(
+                self.language, self.max_image_width, self.char_vector
+            ).encode("utf-8")
+        ).hexdigest()[:12]
+        return os.path.join(self.trdg_cache_path, "{}-{}".format(self.language, key))
+
+    def render_cache_shards(self, path, shards):
+        random.seed(os.getpid())
+        examples = self.render_examples()
+        for shard in shards:
             batch = []
-            while len(batch) < self.batch_size:
-                img, lbl = generator.next()
-                batch.append(
-                    (
-                        resize_image(np.array(img.convert("L")), self.max_image_width)[
-                            0
-                        ],
-                        lbl,
-                        label_to_array(lbl, self.char_vector),
-                    )
-                )
+            for _ in range(shard["count"]):
+                arr, lbl, width = next(examples)
+                batch.append((arr, lbl, self.charset.encode(lbl), width))
+            write_shard(os.path.join(path, shard["name"]), batch, self.max_image_width)
 
-            raw_batch_x, raw_batch_y, raw_batch_la = zip(*batch)
+    def build_trdg_cache(self, num_workers, shard_size=10000):
+        """Renders trdg_cache_size samples once, in num_workers processes
 
-            batch_y = np.reshape(np.array(raw_batch_y), (-1))
+        A cache holding fewer samples is topped up, one holding more is used as is.
 
-            batch_dt = sparse_tuple_from(
-                np.reshape(np.array(raw_batch_la), (-1)))
+        return: path of the cache, usable as a ShardDataset
+        """
 
-            raw_batch_x = np.swapaxes(raw_batch_x, 1, 2)
+        path = self.trdg_cache_dir()
+        shards = []
+        if os.path.isfile(os.path.join(path, SHARD_INDEX)):
+            with open(os.path.join(path, SHARD_INDEX), "r") as f:
+                shards = json.load(f)["shards"]
+        cached = sum(shard["count"] for shard in shards)
+        if cached >= self.trdg_cache_size:
+            print("Using TRDG cache {} ({} samples)".format(path, cached))
+            return path
+
+        missing = self.trdg_cache_size - cached
+        print("Rendering {} TRDG samples into {}".format(missing, path))
+        start = time.time()
+
+        # New shards are numbered after the existing ones
+        first = len(shards)
+        processes = []
+        for i in range(num_workers):
+            count = missing // num_workers
+            if i < missing % num_workers:
+                count += 1
+            worker_shards = [
+                {
+                    "name": "shard-{:02d}-{:05d}".format(i, first + j),
+                    "count": min(shard_size, count - j * shard_size),
+                }
+                for j in range(-(-count // shard_size))
+            ]
+            shards.extend(worker_shards)
+            processes.append(
+                Process(target=self.render_cache_shards, args=(path, worker_shards))
+            )
+            processes[-1].start()
 
-            raw_batch_x = raw_batch_x / 255.0
+        try:
+            for p in processes:
+                p.join()
+                if p.exitcode != 0:
+                    raise Exception("Error: TRDG cache rendering failed")
+        finally:
+            for p in processes:
+                if p.is_alive():
+                    p.terminate()
+
+        # The index only lists the new shards once they are all written
+        write_index(path, self.max_image_width, self.char_vector, shards)
+        print("TRDG cache rendered in {:.1f}s".format(time.time() - start))
+        return path
+
+    def batch_generator(self):
+        """Yields batches of TRDG samples, freshly rendered or read from the cache
+        """
 
-            batch_x = np.reshape(
-                np.array(raw_batch_x), (len(raw_batch_x),
-                                        self.max_image_width, 32, 1)
+        fresh = self.render_examples()
+        cache = None
+        if self.trdg_cache is not None:
+            cache = ShardDataset(
+                self.trdg_cache,
+                self.max_image_width,
+                self.char_vector,
+                self.max_char_count,
             )
-            if queue.qsize() < 20:
-                queue.put((batch_y, batch_dt, batch_x))
+
+        pending = {}
+        while True:
+            # Cached samples keep their label indices, fresh ones are encoded per batch
+            if cache is not None and random.random() >= self.trdg_fresh_ratio:
+                arr, lbl, label, width = cache[random.randrange(len(cache))]
             else:
-                pass
+                arr, lbl, width = next(fresh)
+                label = None
 
-    def multiprocess_batch_generator(self):
-        """Returns a batch generator to use in training
+            bucket = self.bucket_of(width) if self.width_buckets else 0
+            pending.setdefault(bucket, []).append((arr, lbl, label, width))
+            if len(pending[bucket]) < self.batch_size:
+                continue
+
+            examples = pending.pop(bucket)
+            rendered = [i for i, example in enumerate(examples) if example[2] is None]
+            if rendered:
+                values, lengths = self.charset.encode_batch(
+                    [examples[i][1] for i in rendered]
+                )
+                for i, label in zip(
+                    rendered, np.split(values, np.cumsum(lengths)[:-1])
+                ):
+                    examples[i] = (examples[i][0], examples[i][1], label, examples[i][3])
+
+            yield self.make_batch(examples)
+
+    def close(self):
+        """Stops the TRDG worker processes
         """
 
-        q = Queue()
-        processes = []
-        for i in range(2):
-            processes.append(Process(target=self.batch_generator, args=(q,)))
-            processes[-1].start()
-        while True:
-            yield q.get()
+        if self.worker_pool is not None:
+            self.worker_pool.shutdown()
+
+    def decode_files(self, files):
+        """
+        Decode files of examples_path, in load_workers processes
+
+        return: List with a (status, example) tuple per file, see load_example
+        """
+
+        load = functools.partial(
+            load_example,
+            examples_path=self.examples_path,
+            max_image_width=self.max_image_width,
+            char_vector=self.char_vector,
+        )
+
+        if self.load_workers > 1:
+            # Terminated on exit, after every file was decoded or on error
+            with Pool(self.load_workers) as pool:
+                # imap keeps the order of files
+                return self.collect_decoded(
+                    pool.imap(load, files, chunksize=self.load_chunk_size), len(files)
+                )
+        return self.collect_decoded(map(load, files), len(files))
+
+    @staticmethod
+    def collect_decoded(results, total):
+        """
+        Gather the (status, example) results of decode_files, reporting the
+        progress and the skipped files
+        """
+
+        decoded = []
+        skipped = {"unreadable": 0, "charset": 0}
+        start = time.time()
+        for count, (status, example) in enumerate(results, 1):
+            decoded.append((status, example))
+            if status != "ok":
+                skipped[status] += 1
+
+            if count % 10000 == 0 or count == total:
+                print(
+                    "\t{}/{} files, {:.0f} files/s".format(
+                        count, total, count / max(time.time() - start, 1e-6)
+                    )
+                )
+
+        print(
+            "Skipped {} unreadable files and {} labels out of the charset".format(
+                skipped["unreadable"], skipped["charset"]
+            )
+        )
+        return decoded
 
     def load_data(self):
         """
         Load all the images in the folder
 
-        return: List with tuples (img_arr, label_string, label_index_array) and list length
+        Unreadable files and labels with characters out of the charset are
+        skipped and counted.
+
+        return: List with tuples (img_arr, label_string, label_index_array, width) and list length
         """
 
         # TODO:: Change this for different format of data.
         print("Loading data")
 
-        examples = []
+        files = [
+            f
+            for f in os.listdir(self.examples_path)
+            if label_length(f) <= self.max_char_count
+        ]
+
+        examples = [
+            example for status, example in self.decode_files(files) if status == "ok"
+        ]
 
-        count = 0
-        skipped = 0
-        for f in os.listdir(self.examples_path):
-            if len(f.split("_")[0]) > self.max_char_count:
-                continue
-            arr, initial_len = resize_image(
-                np.array(Image.open(os.path.join(
-                    self.examples_path, f), mode="r")),
-                self.max_image_width,
-            )
-            examples.append(
-                (
-                    arr,
-                    f.split("_")[0],
-                    label_to_array(f.split("_")[0], self.char_vector),
-                )
-            )
-            count += 1
-        
         if len(examples) < self.batch_size:
-            raise "Error: Data less than batch size"
+            raise Exception("Error: Data less than batch size")
 
         return examples, len(examples)
 
-    def generate_all_train_batches(self):
-        train_batches = []
-        while not self.current_train_offset + self.batch_size > self.test_offset:
-            old_offset = self.current_train_offset
+    def load_manifest(self):
+        """
+        Load the examples through the manifest kept in manifest_path
+
+        The manifest records the mtime, size, label, label indices, width and
+        shard row of every file. Only new or modified files are decoded, into a
+        new shard, everything else is memory-mapped from the previous shards.
+        Shards where more than half the rows belong to removed or modified
+        files are rewritten with the other rows.
+
+        Data-parallel workers other than shard_index 0 wait for data_ready and
+        only read the manifest, they never write or delete a shard.
 
-            new_offset = self.current_train_offset + self.batch_size
+        return: ShardDataset indexable like the list returned by load_data and its length
+        """
 
-            self.current_train_offset = new_offset
+        if self.data_ready is not None and self.shard_index != 0:
+            self.data_ready.wait()
+            return self.read_manifest()
+
+        print("Loading manifest")
+
+        manifest_file = os.path.join(self.manifest_path, MANIFEST)
+        entries = {}
+        shards = []
+        if os.path.isfile(manifest_file):
+            with open(manifest_file, "r") as f:
+                manifest = json.load(f)
+            if (
+                manifest["max_image_width"] == self.max_image_width
+                and manifest["char_vector"] == self.char_vector
+            ):
+                entries = manifest["entries"]
+                shards = manifest["shards"]
+            else:
+                print("Manifest was built for another width or charset, rebuilding it")
+
+        files = sorted(os.listdir(self.examples_path))
+        current = {}
+        changed = []
+        for f in files:
+            stat = os.stat(os.path.join(self.examples_path, f))
+            entry = entries.get(f)
+            if (
+                entry is not None
+                and entry["mtime"] == stat.st_mtime
+                and entry["size"] == stat.st_size
+            ):
+                current[f] = entry
+            else:
+                changed.append((f, stat))
 
-            raw_batch_x, raw_batch_y, raw_batch_la = zip(
-                *self.data[old_offset:new_offset]
+        print(
+            "{} unchanged files, {} new or modified files".format(
+                len(current), len(changed)
+            )
+        )
+
+        # New shards never reuse the name of a shard left by an interrupted run
+        names = [shard["name"] for shard in shards]
+        if os.path.isdir(self.manifest_path):
+            names += [n for n in os.listdir(self.manifest_path) if n.startswith("shard-")]
+        shard_ids = itertools.count(max([int(n.split("-")[1]) for n in names] + [-1]) + 1)
+
+        def write_manifest_shard(examples):
+            name = "shard-{:05d}".format(next(shard_ids))
+            write_shard(
+                os.path.join(self.manifest_path, name), examples, self.max_image_width
             )
+            shards.append({"name": name, "count": len(examples)})
+            return name
+
+        if changed:
+            examples = []
+            entries = []
+            decoded = self.decode_files([f for f, _ in changed])
+            for (f, stat), (status, example) in zip(changed, decoded):
+                entry = {
+                    "mtime": stat.st_mtime,
+                    "size": stat.st_size,
+                    "label": f.split("_")[0],
+                }
+                if status == "ok":
+                    entry["row"] = len(examples)
+                    entry["encoded"] = [int(i) for i in example[2]]
+                    entry["width"] = int(example[3])
+                    examples.append(example)
+                    entries.append(entry)
+                else:
+                    entry["skipped"] = status
+                current[f] = entry
+
+            if examples:
+                name = write_manifest_shard(examples)
+                for entry in entries:
+                    entry["shard"] = name
+
+        # Rows of removed or modified files stay in their shard, a shard whose
+        # rows are mostly dead is rewritten with its live rows only
+        live = {}
+        for f in files:
+            if "shard" in current[f]:
+                live.setdefault(current[f]["shard"], []).append(f)
+        for shard in list(shards):
+            kept = live.get(shard["name"], [])
+            if kept and len(kept) * 2 < shard["count"]:
+                arrays = read_shard(os.path.join(self.manifest_path, shard["name"]))
+                name = write_manifest_shard(
+                    [shard_row(arrays, current[f]["row"]) for f in kept]
+                )
+                print("Compacted {} into {} ({} rows)".format(shard["name"], name, len(kept)))
+                for row, f in enumerate(kept):
+                    current[f] = dict(current[f], shard=name, row=row)
+                del live[shard["name"]]
+                live[name] = kept
+        shards = [shard for shard in shards if shard["name"] in live]
+
+        # The new index and manifest replace the old ones before the shards
+        # they do not reference anymore are deleted, a crash in between only
+        # leaves unused shards behind
+        os.makedirs(self.manifest_path, exist_ok=True)
+        write_index(self.manifest_path, self.max_image_width, self.char_vector, shards)
+        with open(manifest_file + ".tmp", "w") as f:
+            json.dump(
+                {
+                    "max_image_width": self.max_image_width,
+                    "char_vector": self.char_vector,
+                    "shards": shards,
+                    "entries": current,
+                },
+                f,
+            )
+        os.replace(manifest_file + ".tmp", manifest_file)
+
+        for name in os.listdir(self.manifest_path):
+            if name.startswith("shard-") and name not in live:
+                shutil.rmtree(os.path.join(self.manifest_path, name), ignore_errors=True)
+
+        if self.data_ready is not None:
+            self.data_ready.set()
 
-            batch_y = np.reshape(np.array(raw_batch_y), (-1))
-            # print(f"Raw batch before Reshape", raw_batch_la)
-            # print(f"Raw batch la {np.reshape(np.array(raw_batch_la), (-1))}")
-            # batch_dt = sparse_tuple_from(np.array(raw_batch_la))
+        return self.manifest_dataset(current)
 
-            batch_dt = sparse_tuple_from(np.array(raw_batch_la))
+    def read_manifest(self):
+        """
+        Load the examples of the manifest as it is, without looking at examples_path
+
+        return: ShardDataset indexable like the list returned by load_data and its length
+        """
+
+        with open(os.path.join(self.manifest_path, MANIFEST), "r") as f:
+            manifest = json.load(f)
+        if (
+            manifest["max_image_width"] != self.max_image_width
+            or manifest["char_vector"] != self.char_vector
+        ):
+            raise Exception("Error: Manifest was built for another width or charset")
+        return self.manifest_dataset(manifest["entries"])
+
+    def manifest_dataset(self, entries):
+        # Sorted by file name, every worker sees the same order
+        data = ShardDataset(
+            self.manifest_path,
+            self.max_image_width,
+            self.char_vector,
+            self.max_char_count,
+            rows=[
+                (entries[f]["shard"], entries[f]["row"])
+                for f in sorted(entries)
+                if "shard" in entries[f]
+            ],
+        )
+
+        if len(data) < self.batch_size:
+            raise Exception("Error: Data less than batch size")
+
+        return data, len(data)
+
+    def list_data(self):
+        """
+        List the images in the folder without decoding them
+
+        return: DirectoryDataset indexable like the list returned by load_data and its length
+        """
 
-            print("\t Batch Label index: {}".format(batch_dt[1]))
+        print("Listing data")
 
-            raw_batch_x = np.swapaxes(raw_batch_x, 1, 2)
+        # Out of charset labels are left out here, the pipeline does not check them
+        files = [
+            f
+            for f in sorted(os.listdir(self.examples_path))
+            if label_length(f) <= self.max_char_count
+            and self.charset.contains(f.split("_")[0])
+        ]
 
-            raw_batch_x = raw_batch_x / 255.0
+        if len(files) < self.batch_size:
+            raise Exception("Error: Data less than batch size")
 
-            batch_x = np.reshape(
-                np.array(raw_batch_x), (len(raw_batch_x),
-                                        self.max_image_width, 32, 1)
-            )
+        data = DirectoryDataset(
+            self.examples_path, files, self.max_image_width, self.char_vector
+        )
+        return data, len(data)
+
+    def load_shards(self):
+        """
+        Memory-map the shards written by shards.pack_shards
+
+        return: ShardDataset indexable like the list returned by load_data and its length
+        """
+
+        print("Loading shards")
+
+        data = ShardDataset(
+            self.shards_path, self.max_image_width, self.char_vector, self.max_char_count
+        )
+
+        if len(data) < self.batch_size:
+            raise Exception("Error: Data less than batch size")
+
+        return data, len(data)
 
-            print("batch x shape:", batch_x.shape)
+    def bucket_of(self, widths):
+        return np.searchsorted(self.width_buckets, widths)
 
-            train_batches.append((batch_y, batch_dt, batch_x))
-        return train_batches
+    def sample_seq_len(self, widths):
+        if self.dynamic_width or self.width_buckets:
+            return compute_sample_seq_len(widths, self.max_char_count)
+        return np.full(len(widths), self.max_char_count, dtype=np.int32)
 
-    def generate_all_test_batches(self):
-        test_batches = []
-        while not self.current_test_offset + self.batch_size > self.data_len:
-            old_offset = self.current_test_offset
+    def decode_file(self, f):
+        """
+        In-graph load_example of a file name of examples_path for the tf.data
+        pipeline, without the GIL bound py_func of example(). Pixels may
+        differ slightly from resize_image, TensorFlow's bicubic resize does
+        not antialias like PIL's.
+
+        return: uint8 (width, 32, 1) image, int32 label index array, sequence length and width
+        """
+
+        # Decoded as RGB, GIF and BMP have no single channel decoding
+        image = tf.io.decode_image(
+            tf.io.read_file(tf.strings.join([self.examples_path + os.sep, f])),
+            channels=3,
+            expand_animations=False,
+        )
+        image.set_shape([None, None, 3])
+        # Same ITU-R 601-2 luma as PIL's convert("L")
+        image = tf.image.rgb_to_grayscale(image)
+        shape = tf.shape(image)
+
+        # Same sizes as resize_image: wider images are squeezed to
+        # max_image_width, the others are scaled to a height of 32 and padded
+        scaled = tf.cast(
+            tf.cast(shape[1], tf.float32) * 32.0 / tf.cast(shape[0], tf.float32), tf.int32
+        )
+        resized_width = tf.maximum(
+            tf.where(shape[1] > self.max_image_width, self.max_image_width, scaled), 1
+        )
+        resized = tf.image.resize_images(
+            image, tf.stack([32, resized_width]), method=tf.image.ResizeMethod.BICUBIC
+        )
+        resized = tf.cast(tf.clip_by_value(tf.round(resized), 0, 255), tf.uint8)
+
+        width = tf.minimum(resized_width, self.max_image_width)
+        arr = tf.pad(
+            resized[:, :width], [[0, 0], [0, self.max_image_width - width], [0, 0]]
+        )
+        if self.dynamic_width:
+            arr = arr[:, : tf.minimum(self.max_image_width, (width + 3) // 4 * 4 + 4)]
+
+        # Label of the file name encoded like Charset.encode_batch, with a
+        # binary search over the sorted code points of the charset
+        label = tf.strings.regex_replace(
+            tf.strings.regex_replace(f, "(?s)_.*", ""), " ", ""
+        )
+        codes = tf.strings.unicode_decode(label, "UTF-8")
+        label = tf.gather(
+            self.charset.code_index,
+            tf.searchsorted(tf.constant(self.charset.codes.astype(np.int32)), codes),
+        )
+
+        if self.dynamic_width or self.width_buckets:
+            seq_len = tf.clip_by_value(-(-width // 4), 1, self.max_char_count)
+        else:
+            seq_len = tf.constant(self.max_char_count, tf.int32)
+
+        return tf.transpose(arr, (1, 0, 2)), label, seq_len, width
+
+    def example(self, i):
+        """
+        Decode data[i] for the tf.data pipeline
 
-            new_offset = self.current_test_offset + self.batch_size
+        return: uint8 (width, 32, 1) image, int32 label index array, sequence length and width
+        """
+
+        arr, _, label, width = self.data[i]
+        if self.dynamic_width:
+            arr = arr[:, : compute_batch_width([width], self.max_image_width)]
+
+        return (
+            np.ascontiguousarray(np.swapaxes(arr, 0, 1)[:, :, np.newaxis], np.uint8),
+            np.asarray(label, dtype=np.int32),
+            self.sample_seq_len([width])[0],
+            np.int32(width),
+        )
+
+    def train_dataset(self, num_parallel_calls, prefetch):
+        """
+        tf.data pipeline over the training data (listed files, shards or TRDG batches)
 
-            self.current_test_offset = new_offset
+        return: Dataset of (images, label indices, label values, label shape, seq_len) batches
+        """
 
-            raw_batch_x, raw_batch_y, raw_batch_la = zip(
-                *self.data[old_offset:new_offset]
+        if self.use_trdg:
+            ring = self.worker_pool.ring
+
+            def batches():
+                for batch_y, (indices, values, shape), batch_x, batch_sl in self.train_batches:
+                    if ring is not None:
+                        # The views on a ring slot are overwritten once the next
+                        # batch is requested, which prefetch does before this
+                        # one is consumed, and py_func shares their memory
+                        values, batch_x, batch_sl = (
+                            np.array(values), np.array(batch_x), np.array(batch_sl)
+                        )
+                    yield batch_y, (indices, values, shape), batch_x, batch_sl
+
+            # TRDG batches are already built by the worker processes
+            dataset = tf.data.Dataset.from_generator(
+                batches,
+                (tf.string, (tf.int64, tf.int32, tf.int64), tf.uint8, tf.int32),
+            )
+            dataset = dataset.map(
+                lambda batch_y, batch_dt, batch_x, batch_sl: (
+                    batch_x,
+                    batch_dt[0],
+                    batch_dt[1],
+                    batch_dt[2],
+                    batch_sl,
+                )
             )
+            return dataset.prefetch(prefetch)
+
+        width = None if self.dynamic_width else self.max_image_width
 
-            batch_y = np.reshape(np.array(raw_batch_y), (-1))
+        def decode(i):
+            image, label, seq_len, w = tf.py_func(
+                self.example, [i], [tf.uint8, tf.int32, tf.int32, tf.int32]
+            )
+            image.set_shape([width, 32, 1])
+            label.set_shape([None])
+            seq_len.set_shape([])
+            w.set_shape([])
+            return image, label, tf.size(label), seq_len, w
+
+        def decode_file(f):
+            image, label, seq_len, w = self.decode_file(f)
+            image.set_shape([width, 32, 1])
+            return image, label, tf.size(label), seq_len, w
+
+        if isinstance(self.data, DirectoryDataset):
+            # Files are decoded, resized and encoded by TensorFlow ops, which
+            # the parallel map really spreads over num_parallel_calls cores
+            files = self.data.files[: self.test_offset][self.shard_index::self.num_shards]
+            dataset = tf.data.Dataset.from_generator(
+                lambda: iter(files), tf.string, tf.TensorShape([])
+            )
+            dataset = dataset.shuffle(len(files), reshuffle_each_iteration=True)
+            dataset = dataset.repeat()
+            dataset = dataset.map(decode_file, num_parallel_calls=num_parallel_calls)
+            # Unreadable files fail their decode and are dropped
+            dataset = dataset.apply(tf.data.experimental.ignore_errors())
+        else:
+            # Shards are already decoded, the py_func only copies memory-mapped rows
+            dataset = tf.data.Dataset.range(self.test_offset)
+            dataset = dataset.shard(self.num_shards, self.shard_index)
+            dataset = dataset.shuffle(self.test_offset, reshuffle_each_iteration=True)
+            dataset = dataset.repeat()
+            dataset = dataset.map(decode, num_parallel_calls=num_parallel_calls)
+
+        padded_shapes = ([width, 32, 1], [None], [], [], [])
+        if self.width_buckets:
+            dataset = dataset.apply(
+                tf.data.experimental.bucket_by_sequence_length(
+                    lambda image, label, label_len, seq_len, w: w,
+                    [w + 1 for w in self.width_buckets[:-1]],
+                    [self.batch_size] * len(self.width_buckets),
+                    padded_shapes=padded_shapes,
+                )
+            )
+        else:
+            dataset = dataset.padded_batch(self.batch_size, padded_shapes)
+
+        def to_sparse(images, labels, label_len, seq_len, w):
+            indices = tf.where(tf.sequence_mask(label_len, tf.shape(labels)[1]))
+            return (
+                images,
+                indices,
+                tf.gather_nd(labels, indices),
+                tf.cast(tf.shape(labels), tf.int64),
+                seq_len,
+            )
 
-            batch_dt = sparse_tuple_from(np.array(raw_batch_la))
+        dataset = dataset.map(to_sparse, num_parallel_calls=num_parallel_calls)
+        return dataset.prefetch(prefetch)
 
-            raw_batch_x = np.swapaxes(raw_batch_x, 1, 2)
+    def make_batch(self, examples):
+        """
+        Build a (batch_y, batch_dt, batch_x, batch_sl) batch from
+        (img_arr, label_string, label_index_array, width) tuples
+        """
 
-            raw_batch_x = raw_batch_x / 255.0
+        raw_batch_x, raw_batch_y, raw_batch_la, raw_batch_w = zip(*examples)
 
-            batch_x = np.reshape(
-                np.array(raw_batch_x), (len(raw_batch_x),
-                                        self.max_image_width, 32, 1)
+        # With a dynamic width graph the batch is cropped to its widest image,
+        # without buckets every sample keeps the full sequence length
+        batch_width = self.max_image_width
+        if self.dynamic_width:
+            batch_width = compute_batch_width(raw_batch_w, self.max_image_width)
+            batch_sl = compute_sample_seq_len(
+                raw_batch_w, compute_seq_len(batch_width)
             )
+        else:
+            batch_sl = self.sample_seq_len(raw_batch_w)
+
+        batch_y = np.reshape(np.array(raw_batch_y), (-1))
+
+        batch_dt = sparse_tuple_from(raw_batch_la)
+
+        # Pixels stay uint8 until feed time, see utils.normalize_batch
+        raw_batch_x = np.swapaxes(
+            np.array(raw_batch_x, dtype=np.uint8)[:, :, :batch_width], 1, 2
+        )
+
+        batch_x = np.reshape(raw_batch_x, (len(raw_batch_x), batch_width, 32, 1))
 
-            test_batches.append((batch_y, batch_dt, batch_x))
-        return test_batches
+        return batch_y, batch_dt, batch_x, batch_sl
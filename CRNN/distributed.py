@@ -0,0 +1,150 @@
+import os
+import shutil
+import tempfile
+import multiprocessing
+import numpy as np
+
+
+class AllReduce(object):
+    """
+        Averages lists of numpy arrays across the worker processes of one host.
+
+        The arrays go through a memory-mapped file, in /dev/shm when available,
+        with one row per worker and a last row for the average. Each worker
+        writes its row, averages its own chunk of the columns (reduce-scatter)
+        and reads the whole average back, with a barrier wait in between.
+        The file is sized on the first call, once the workers know the size
+        of their arrays.
+    """
+
+    def __init__(self, path, rank, num_workers, barrier):
+        self.path = path
+        self.rank = rank
+        self.num_workers = num_workers
+        self.barrier = barrier
+        self.buffers = None
+
+    def setup(self, size):
+        filename = os.path.join(self.path, "buffers")
+        shape = (self.num_workers + 1, size)
+        if self.rank == 0:
+            np.memmap(filename, dtype=np.float32, mode="w+", shape=shape).flush()
+        self.barrier.wait()
+        self.buffers = np.memmap(filename, dtype=np.float32, mode="r+", shape=shape)
+
+        bounds = np.linspace(0, size, self.num_workers + 1).astype(np.int64)
+        self.chunk = slice(bounds[self.rank], bounds[self.rank + 1])
+
+    def flatten(self, arrays):
+        flat = np.concatenate([np.ravel(a) for a in arrays]).astype(np.float32)
+        if self.buffers is None:
+            self.setup(flat.size)
+        return flat
+
+    @staticmethod
+    def unflatten(flat, arrays):
+        result = []
+        offset = 0
+        for a in arrays:
+            size = np.size(a)
+            result.append(flat[offset: offset + size].reshape(np.shape(a)))
+            offset += size
+        return result
+
+    def mean(self, arrays):
+        """
+            Average of arrays over all the workers, every worker must call it
+        """
+
+        self.buffers[self.rank] = self.flatten(arrays)
+        self.barrier.wait()
+        self.buffers[-1, self.chunk] = self.buffers[:-1, self.chunk].mean(
+            axis=0, dtype=np.float32
+        )
+        self.barrier.wait()
+        return self.unflatten(np.array(self.buffers[-1]), arrays)
+
+    def broadcast(self, arrays):
+        """
+            arrays of rank 0, every worker must call it
+        """
+
+        flat = self.flatten(arrays)
+        # Everyone has read the result of the previous call
+        self.barrier.wait()
+        if self.rank == 0:
+            self.buffers[-1] = flat
+        self.barrier.wait()
+        result = self.unflatten(np.array(self.buffers[-1]), arrays)
+        # Nobody writes the average row again before everyone has read it
+        self.barrier.wait()
+        return result
+
+
+def train_worker(
+    rank, num_workers, path, barrier, data_ready, iteration_count, crnn_args, crnn_kwargs
+):
+    # Imported by the spawned worker only, AllReduce does not need TensorFlow
+    from crnn import CRNN
+
+    crnn = CRNN(
+        *crnn_args,
+        num_workers=num_workers,
+        rank=rank,
+        all_reduce=AllReduce(path, rank, num_workers, barrier),
+        data_ready=data_ready,
+        **crnn_kwargs
+    )
+    try:
+        crnn.train(iteration_count)
+    finally:
+        crnn.data_manager.close()
+
+
+def train_data_parallel(num_workers, iteration_count, crnn_args, crnn_kwargs, timeout=600):
+    """
+        Train in num_workers local processes, each one running CRNN(*crnn_args,
+        **crnn_kwargs) on its shard of the data. Gradients are averaged every
+        step and only rank 0 writes checkpoints, summaries and frozen graphs.
+
+        A worker waiting more than timeout seconds for the others fails, and
+        the failure of any worker stops all of them. Rank 0 refreshes the
+        manifest or TRDG cache while the others wait for it, without timeout.
+        Each rank renders its own TRDG stream.
+    """
+
+    # Workers are spawned, the caller may already run TensorFlow sessions and
+    # their threads would not survive a fork
+    context = multiprocessing.get_context("spawn")
+    barrier = context.Barrier(num_workers, timeout=timeout)
+    data_ready = context.Event()
+    path = tempfile.mkdtemp(
+        prefix="crnn-allreduce-", dir="/dev/shm" if os.path.isdir("/dev/shm") else None
+    )
+
+    processes = [
+        context.Process(
+            target=train_worker,
+            args=(
+                rank, num_workers, path, barrier, data_ready, iteration_count, crnn_args, crnn_kwargs
+            ),
+        )
+        for rank in range(num_workers)
+    ]
+    try:
+        for p in processes:
+            p.start()
+        while any(p.is_alive() for p in processes):
+            for p in processes:
+                p.join(1)
+            if any(p.exitcode not in (None, 0) for p in processes):
+                raise Exception(
+                    "Data-parallel worker failed, exit codes {}".format(
+                        [p.exitcode for p in processes]
+                    )
+                )
+    finally:
+        for p in processes:
+            if p.is_alive():
+                p.terminate()
+        shutil.rmtree(path, ignore_errors=True)
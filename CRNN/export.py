@@ -0,0 +1,357 @@
+import os
+import time
+import json
+import numpy as np
+import tensorflow as tf
+
+from PIL import Image
+from tensorflow.python.framework import tensor_util
+from tensorflow.python.tools import optimize_for_inference_lib
+from tensorflow.tools.graph_transforms import TransformGraph
+from predictor import Predictor
+from utils import resize_image, normalize_batch, compute_seq_len, levenshtein, Charset
+
+INPUT_NODES = ["input", "seq_len"]
+OUTPUT_NODES = [
+    "dense_decoded",
+    "dense_decoded_greedy",
+    "dense_decoded_beam",
+    "confidence",
+    "confidence_greedy",
+    "confidence_beam",
+    "logits",
+]
+# Ops of the tf.while_loop of the BasicLSTMCell BiLSTM, which TFLite cannot convert
+WHILE_LOOP_OPS = {"Enter", "Exit", "LoopCond", "NextIteration"}
+
+
+def load_graph_def(path):
+    graph_def = tf.GraphDef()
+    with tf.gfile.GFile(path, "rb") as f:
+        graph_def.ParseFromString(f.read())
+    return graph_def
+
+
+def write_graph_def(graph_def, path):
+    with tf.gfile.GFile(path, "wb") as f:
+        f.write(graph_def.SerializeToString())
+
+
+def constant_value(nodes, name):
+    """
+        Value of a frozen Const node, following the Identity (variable read) nodes
+    """
+
+    node = nodes[name.split(":")[0]]
+    while node.op == "Identity":
+        node = nodes[node.input[0].split(":")[0]]
+    if node.op != "Const":
+        return None
+    return tensor_util.MakeNdarray(node.attr["value"].tensor)
+
+
+def const_node(name, value):
+    node = tf.NodeDef(name=name, op="Const")
+    node.attr["dtype"].type = tf.as_dtype(value.dtype).as_datatype_enum
+    node.attr["value"].tensor.CopyFrom(tensor_util.make_tensor_proto(value))
+    return node
+
+
+def fold_batch_norms(graph_def, output_nodes):
+    """
+        Replace every inference FusedBatchNorm by a multiplication and an
+        addition with precomputed per-channel scale and offset.
+
+        The batch norms of the CNN follow a ReLU, not a convolution, so they
+        cannot be merged into the convolution weights (optimize_for_inference
+        only folds the ones directly after a Conv2D).
+    """
+
+    nodes = {node.name: node for node in graph_def.node}
+    output = tf.GraphDef()
+    output.versions.CopyFrom(graph_def.versions)
+    output.library.CopyFrom(graph_def.library)
+
+    for node in graph_def.node:
+        if not node.op.startswith("FusedBatchNorm") or node.attr["is_training"].b:
+            output.node.extend([node])
+            continue
+
+        gamma, beta, mean, variance = [constant_value(nodes, i) for i in node.input[1:5]]
+        if any(v is None for v in (gamma, beta, mean, variance)):
+            output.node.extend([node])
+            continue
+
+        scale = (gamma / np.sqrt(variance + node.attr["epsilon"].f)).astype(np.float32)
+        offset = (beta - mean * scale).astype(np.float32)
+
+        mul = tf.NodeDef(name=node.name + "/folded_mul", op="Mul")
+        mul.input.extend([node.input[0], node.name + "/folded_scale"])
+        mul.attr["T"].CopyFrom(node.attr["T"])
+
+        # Keeps the name so that its consumers are unchanged
+        add = tf.NodeDef(name=node.name, op="Add")
+        add.input.extend([mul.name, node.name + "/folded_offset"])
+        add.attr["T"].CopyFrom(node.attr["T"])
+
+        output.node.extend(
+            [
+                const_node(node.name + "/folded_scale", scale),
+                const_node(node.name + "/folded_offset", offset),
+                mul,
+                add,
+            ]
+        )
+
+    # The gamma, beta and moving statistics constants are not used anymore
+    return tf.graph_util.extract_sub_graph(output, output_nodes)
+
+
+def cast_weights_to_float16(graph_def, minimum_size=1024):
+    """
+        Store the float32 constants of at least minimum_size elements as
+        float16, cast back to float32 when the graph is loaded
+    """
+
+    output = tf.GraphDef()
+    output.versions.CopyFrom(graph_def.versions)
+    output.library.CopyFrom(graph_def.library)
+
+    for node in graph_def.node:
+        value = None
+        if node.op == "Const" and node.attr["dtype"].type == tf.float32.as_datatype_enum:
+            value = tensor_util.MakeNdarray(node.attr["value"].tensor)
+        if value is None or value.size < minimum_size:
+            output.node.extend([node])
+            continue
+
+        cast = tf.NodeDef(name=node.name, op="Cast")
+        cast.input.append(node.name + "/float16")
+        cast.attr["SrcT"].type = tf.float16.as_datatype_enum
+        cast.attr["DstT"].type = tf.float32.as_datatype_enum
+        output.node.extend([const_node(node.name + "/float16", value.astype(np.float16)), cast])
+    return output
+
+
+def optimize_graph(graph_def, input_nodes=INPUT_NODES, output_nodes=OUTPUT_NODES, quantize=None):
+    """
+        Inference graph of a frozen CRNN: training nodes stripped, batch norms
+        folded and weights optionally quantized to "int8" or "float16"
+    """
+
+    output_nodes = [n for n in output_nodes if n in set(node.name for node in graph_def.node)]
+    shapes = {
+        node.name: node.attr["shape"]
+        for node in graph_def.node
+        if node.name in input_nodes and "shape" in node.attr
+    }
+
+    graph_def = optimize_for_inference_lib.optimize_for_inference(
+        graph_def,
+        input_nodes,
+        output_nodes,
+        [tf.float32.as_datatype_enum, tf.int32.as_datatype_enum],
+    )
+    # The new placeholders lose their shape, Predictor reads the input width from it
+    for node in graph_def.node:
+        if node.name in shapes:
+            node.attr["shape"].CopyFrom(shapes[node.name])
+
+    graph_def = fold_batch_norms(graph_def, output_nodes)
+
+    if quantize == "int8":
+        graph_def = TransformGraph(
+            graph_def, input_nodes, output_nodes, ["quantize_weights(minimum_size=1024)"]
+        )
+    elif quantize == "float16":
+        graph_def = cast_weights_to_float16(graph_def)
+    elif quantize:
+        raise ValueError("Unknown quantization {}, use int8 or float16".format(quantize))
+    return graph_def
+
+
+def has_while_loop(graph_def):
+    """
+        Whether the input -> logits part of graph_def runs a while loop, which
+        is the case of graphs frozen with --rnn_cell basic
+    """
+
+    logits_graph_def = tf.graph_util.extract_sub_graph(graph_def, ["logits"])
+    return any(node.op in WHILE_LOOP_OPS for node in logits_graph_def.node)
+
+
+def export_tflite(frozen_model_path, path, max_image_width):
+    """
+        Convert the input -> logits part of a frozen graph to TFLite, for a
+        single image of max_image_width. The CTC decoders have no TFLite
+        kernels, the logits are decoded in numpy (see greedy_decode).
+
+        Only graphs frozen with --rnn_cell fused can be converted.
+    """
+
+    if has_while_loop(load_graph_def(frozen_model_path)):
+        raise ValueError(
+            "{} was frozen with --rnn_cell basic, whose while loops cannot be converted "
+            "to TFLite. Convert the checkpoint to --rnn_cell fused and freeze it "
+            "again".format(frozen_model_path)
+        )
+
+    converter = tf.lite.TFLiteConverter.from_frozen_graph(
+        frozen_model_path,
+        INPUT_NODES,
+        ["logits"],
+        input_shapes={"input": [1, max_image_width, 32, 1], "seq_len": [1]},
+    )
+    # The fused LSTM kernel has no TFLite builtin and needs the TensorFlow one
+    converter.target_spec.supported_ops = set(
+        [tf.lite.OpsSet.TFLITE_BUILTINS, tf.lite.OpsSet.SELECT_TF_OPS]
+    )
+    with open(path, "wb") as f:
+        f.write(converter.convert())
+
+
+def greedy_decode(logits, seq_len, charset):
+    """
+        Best path decoding of [max_time, batch_size, num_classes] logits
+    """
+
+    best = np.argmax(logits, axis=2)
+    blank = logits.shape[2] - 1
+    predictions = []
+    for i in range(best.shape[1]):
+        path = best[: seq_len[i], i]
+        keep = np.ones(len(path), dtype=bool)
+        keep[1:] = path[1:] != path[:-1]
+        predictions.append(charset.decode(path[keep & (path != blank)]))
+    return predictions
+
+
+def load_held_out(examples_path, max_examples):
+    files = sorted(os.listdir(examples_path))[:max_examples]
+    return [os.path.join(examples_path, f) for f in files], [f.split("_")[0] for f in files]
+
+
+def score(labels, predictions, elapsed, model_path, decoder):
+    errors = sum(levenshtein(l, p) for l, p in zip(labels, predictions))
+    return {
+        "model": model_path,
+        "decoder": decoder,
+        "size_bytes": os.path.getsize(model_path),
+        "accuracy": float(np.mean([l == p for l, p in zip(labels, predictions)])),
+        "character_error_rate": errors / max(sum(len(l) for l in labels), 1),
+        "images_per_second": len(labels) / max(elapsed, 1e-9),
+    }
+
+
+def evaluate_graph(model_path, char_vector, files, labels, max_image_width, decoder=None):
+    predictor = Predictor(
+        model_path, char_vector, max_image_width=max_image_width, decoder=decoder
+    )
+    try:
+        # The first run initializes the session, it is not timed
+        predictor.predict(files[:1])
+        start = time.time()
+        predictions = predictor.predict(files)
+        return score(
+            labels, predictions, time.time() - start, model_path, decoder or "dense_decoded"
+        )
+    finally:
+        predictor.close()
+
+
+def evaluate_tflite(model_path, char_vector, files, labels, max_image_width):
+    interpreter = tf.lite.Interpreter(model_path=model_path)
+    interpreter.allocate_tensors()
+    inputs = {d["name"]: d["index"] for d in interpreter.get_input_details()}
+    logits_index = interpreter.get_output_details()[0]["index"]
+    charset = Charset(char_vector)
+
+    predictions = []
+    start = time.time()
+    for f in files:
+        arr, _ = resize_image(np.array(Image.open(f, mode="r")), max_image_width)
+        batch_x = np.reshape(np.swapaxes(arr, 0, 1), (1, max_image_width, 32, 1))
+        seq_len = np.array([compute_seq_len(max_image_width)], dtype=np.int32)
+        interpreter.set_tensor(inputs["input"], normalize_batch(batch_x))
+        interpreter.set_tensor(inputs["seq_len"], seq_len)
+        interpreter.invoke()
+        predictions.extend(
+            greedy_decode(interpreter.get_tensor(logits_index), seq_len, charset)
+        )
+    return score(labels, predictions, time.time() - start, model_path, "numpy greedy")
+
+
+def export(
+    frozen_model_path,
+    output_path,
+    char_vector,
+    max_image_width,
+    quantize=None,
+    tflite=False,
+    eval_path=None,
+    max_eval_examples=1000,
+    report_path=None,
+):
+    """
+        Write the optimized graph (and TFLite model) of frozen_model_path, then
+        compare their accuracy and speed with it on the examples of eval_path
+    """
+
+    graph_def = optimize_graph(load_graph_def(frozen_model_path), quantize=quantize)
+    write_graph_def(graph_def, output_path)
+    print(
+        "Optimized graph written to {} ({} -> {} bytes)".format(
+            output_path, os.path.getsize(frozen_model_path), os.path.getsize(output_path)
+        )
+    )
+
+    tflite_path = None
+    if tflite and has_while_loop(load_graph_def(frozen_model_path)):
+        print(
+            "Skipping the TFLite export, {} was frozen with --rnn_cell basic. Only "
+            "--rnn_cell fused graphs can be converted".format(frozen_model_path)
+        )
+    elif tflite:
+        tflite_path = os.path.splitext(output_path)[0] + ".tflite"
+        export_tflite(frozen_model_path, tflite_path, max_image_width)
+        print("TFLite model written to {}".format(tflite_path))
+
+    if not eval_path:
+        return None
+
+    files, labels = load_held_out(eval_path, max_eval_examples)
+    report = [
+        evaluate_graph(frozen_model_path, char_vector, files, labels, max_image_width),
+        evaluate_graph(output_path, char_vector, files, labels, max_image_width),
+    ]
+    if tflite_path:
+        try:
+            report.append(
+                evaluate_tflite(tflite_path, char_vector, files, labels, max_image_width)
+            )
+            # Same decoder as the TFLite model for a fair comparison
+            report.append(
+                evaluate_graph(
+                    frozen_model_path, char_vector, files, labels, max_image_width, decoder="greedy"
+                )
+            )
+        except RuntimeError as e:
+            # The Python interpreter has no delegate for the TensorFlow kernels
+            # (Flex ops) the fused LSTM needs, the model runs on mobile runtimes
+            print("Skipping the TFLite evaluation: {}".format(e))
+
+    for result in report:
+        print(
+            "\t{:<32} {:<14} {:>10} bytes  accuracy {:.4f}  CER {:.4f}  {:.1f} images/s".format(
+                result["model"],
+                result["decoder"],
+                result["size_bytes"],
+                result["accuracy"],
+                result["character_error_rate"],
+                result["images_per_second"],
+            )
+        )
+    if report_path:
+        with open(report_path, "w") as f:
+            json.dump(report, f, indent=2)
+    return report
@@ -0,0 +1,157 @@
+import os
+import math
+import functools
+import numpy as np
+
+from utils import get_charset
+
+NEG_INF = float("-inf")
+
+
+def log_add(a, b):
+    if a == NEG_INF:
+        return b
+    if b == NEG_INF:
+        return a
+    if a < b:
+        a, b = b, a
+    return a + math.log1p(math.exp(b - a))
+
+
+class Trie(object):
+    """
+        Prefix tree of the lexicon words, over class indices.
+
+        Node 0 is the root, children[node] maps a class index to the child
+        node and words[node] is the word ending at node, if any.
+    """
+
+    def __init__(self):
+        self.children = [{}]
+        self.words = [None]
+
+    def add(self, word, indices):
+        node = 0
+        for c in indices:
+            child = self.children[node].get(c)
+            if child is None:
+                child = len(self.children)
+                self.children[node][c] = child
+                self.children.append({})
+                self.words.append(None)
+            node = child
+        if node != 0:
+            self.words[node] = word
+
+    def __len__(self):
+        return sum(word is not None for word in self.words)
+
+
+def load_lexicon(path, char_vector):
+    """
+        Trie of the words of a file (one per line), words with characters
+        outside of the charset are skipped. Cached until the file changes.
+    """
+
+    return _load_lexicon(path, os.path.getmtime(path), char_vector)
+
+
+@functools.lru_cache(maxsize=8)
+def _load_lexicon(path, mtime, char_vector):
+    charset = get_charset(char_vector)
+    trie = Trie()
+    skipped = 0
+    with open(path, "r") as f:
+        for line in f:
+            word = line.strip("\n")
+            if not word:
+                continue
+            if not charset.contains(word):
+                skipped += 1
+                continue
+            trie.add(word, charset.encode(word))
+    if skipped:
+        print("{} lexicon words are not in the charset".format(skipped))
+    return trie
+
+
+class LexiconDecoder(object):
+    """
+        CTC prefix beam search restricted to the words of a lexicon.
+
+        Works on the time-major logits node of CRNN.crnn, whose last class is
+        the CTC blank. A prefix is only extended with the characters its trie
+        node has children for, and only with those whose log probability at
+        that step is above prune_log_prob, so most of the beam search is
+        never computed.
+    """
+
+    def __init__(self, lexicon_path, char_vector, beam_width=10, prune_log_prob=math.log(1e-4)):
+        self.trie = load_lexicon(lexicon_path, char_vector)
+        self.beam_width = beam_width
+        self.prune_log_prob = prune_log_prob
+
+    def decode(self, logits, seq_len):
+        """
+            logits: [max_time, batch_size, num_classes] array
+            return: (word, log probability) of every sequence, ("", -inf) when
+            no word of the lexicon fits it
+        """
+
+        logits = np.asarray(logits, dtype=np.float32)
+        log_probs = logits - logits.max(axis=2, keepdims=True)
+        log_probs -= np.log(np.exp(log_probs).sum(axis=2, keepdims=True))
+
+        return [
+            self.decode_sequence(log_probs[: seq_len[i], i])
+            for i in range(log_probs.shape[1])
+        ]
+
+    def decode_sequence(self, log_probs):
+        children, words = self.trie.children, self.trie.words
+        blank = log_probs.shape[1] - 1
+
+        # prefix -> [blank ending log prob, non blank ending log prob, trie node]
+        beams = {(): [0.0, NEG_INF, 0]}
+        for step in log_probs:
+            step_blank = float(step[blank])
+            candidates = set(np.flatnonzero(step[:blank] > self.prune_log_prob).tolist())
+
+            next_beams = {}
+            for prefix, (p_b, p_nb, node) in beams.items():
+                total = log_add(p_b, p_nb)
+
+                beam = next_beams.setdefault(prefix, [NEG_INF, NEG_INF, node])
+                beam[0] = log_add(beam[0], total + step_blank)
+                if prefix:
+                    # Repeated character without a blank, collapsed by CTC
+                    last = prefix[-1]
+                    beam[1] = log_add(beam[1], p_nb + float(step[last]))
+
+                node_children = children[node]
+                if len(node_children) < len(candidates):
+                    extensions = [c for c in node_children if c in candidates]
+                else:
+                    extensions = [c for c in candidates if c in node_children]
+                for c in extensions:
+                    # A repeated character needs a blank in between
+                    p = (p_b if prefix and c == prefix[-1] else total) + float(step[c])
+                    beam = next_beams.setdefault(
+                        prefix + (c,), [NEG_INF, NEG_INF, node_children[c]]
+                    )
+                    beam[1] = log_add(beam[1], p)
+
+            beams = dict(
+                sorted(
+                    next_beams.items(),
+                    key=lambda item: log_add(item[1][0], item[1][1]),
+                    reverse=True,
+                )[: self.beam_width]
+            )
+
+        best, best_log_prob = "", NEG_INF
+        for p_b, p_nb, node in beams.values():
+            log_prob = log_add(p_b, p_nb)
+            if words[node] is not None and log_prob > best_log_prob:
+                best, best_log_prob = words[node], log_prob
+        return best, best_log_prob
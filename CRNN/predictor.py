@@ -0,0 +1,242 @@
+import itertools
+import numpy as np
+import tensorflow as tf
+
+from PIL import Image
+from lexicon import LexiconDecoder
+from utils import (
+    resize_image,
+    compute_batch_width,
+    compute_seq_len,
+    compute_sample_seq_len,
+    normalize_batch,
+    Charset,
+)
+
+
+class Predictor(object):
+    """
+        Standalone inference on a frozen CRNN graph (see CRNN.save_frozen_model).
+
+        Only the input -> dense_decoded subgraph is loaded, so neither the
+        optimizer, the CTC loss nor a DataManager are built. Graphs exported
+        with a dynamic width need max_image_width, batches are then cropped
+        to their widest image.
+
+        decoder picks the dense_decoded_greedy or dense_decoded_beam output
+        instead of dense_decoded, beam_width overrides the exported one.
+
+        With a cascade_threshold, batches are decoded greedily and only the
+        sequences less confident than the threshold are decoded again with
+        the beam search, from the logits of the first pass.
+
+        With a lexicon_path, the logits are decoded in numpy against the
+        words of that file instead (see LexiconDecoder). It cannot be
+        combined with a cascade_threshold.
+    """
+
+    def __init__(
+        self,
+        frozen_model_path,
+        char_vector,
+        batch_size=64,
+        input_node="input",
+        seq_len_node="seq_len",
+        output_node="dense_decoded",
+        width_buckets=None,
+        max_image_width=None,
+        decoder=None,
+        beam_width=None,
+        cascade_threshold=None,
+        lexicon_path=None,
+        lexicon_beam_width=10,
+        session_config=None,
+    ):
+        if lexicon_path and cascade_threshold is not None:
+            raise ValueError("lexicon_path and cascade_threshold cannot be used together")
+
+        self.charset = Charset(char_vector)
+        self.batch_size = batch_size
+        self.width_buckets = sorted(width_buckets) if width_buckets else None
+
+        graph_def = tf.GraphDef()
+        with tf.gfile.GFile(frozen_model_path, "rb") as f:
+            graph_def.ParseFromString(f.read())
+
+        confidence_node = "confidence"
+        if decoder:
+            output_node = "dense_decoded_" + decoder
+            confidence_node = "confidence_" + decoder
+        if beam_width:
+            for node in graph_def.node:
+                if node.op == "CTCBeamSearchDecoder":
+                    node.attr["beam_width"].i = beam_width
+
+        self.graph = tf.Graph()
+        with self.graph.as_default():
+            tf.import_graph_def(graph_def, name="")
+
+        self.inputs = self.graph.get_tensor_by_name(input_node + ":0")
+        self.seq_len = self.graph.get_tensor_by_name(seq_len_node + ":0")
+        self.decoded = self.graph.get_tensor_by_name(output_node + ":0")
+        # Graphs frozen before the confidence outputs were added have none
+        self.confidence = self.get_tensor(confidence_node)
+
+        self.lexicon = None
+        if lexicon_path:
+            self.lexicon = LexiconDecoder(lexicon_path, char_vector, lexicon_beam_width)
+            self.logits = self.graph.get_tensor_by_name("logits:0")
+
+        self.cascade_threshold = cascade_threshold
+        if cascade_threshold is not None:
+            self.logits = self.graph.get_tensor_by_name("logits:0")
+            self.greedy = (
+                self.graph.get_tensor_by_name("dense_decoded_greedy:0"),
+                self.graph.get_tensor_by_name("confidence_greedy:0"),
+            )
+            self.beam = (
+                self.graph.get_tensor_by_name("dense_decoded_beam:0"),
+                self.graph.get_tensor_by_name("confidence_beam:0"),
+            )
+
+        self.max_image_width = self.inputs.get_shape().as_list()[1]
+        self.dynamic_width = self.max_image_width is None
+        if self.dynamic_width:
+            if not max_image_width:
+                raise ValueError("max_image_width is required with a dynamic width graph")
+            self.max_image_width = max_image_width
+        self.max_char_count = compute_seq_len(self.max_image_width)
+
+        self.session = tf.Session(graph=self.graph, config=session_config)
+
+    def get_tensor(self, name):
+        try:
+            return self.graph.get_tensor_by_name(name + ":0")
+        except KeyError:
+            return None
+
+    def preprocess(self, image):
+        """
+            Turn a file path, PIL image or numpy array into a (32, max_image_width) array
+            and the width of the image inside it
+        """
+
+        if isinstance(image, str):
+            image = Image.open(image, mode="r")
+        if isinstance(image, Image.Image):
+            image = np.array(image)
+        return resize_image(image, self.max_image_width)
+
+    def predict_batch(self, examples, with_confidence=False):
+        """
+            Run a single session.run (two with the cascade) on already
+            preprocessed examples, with_confidence returns (text, confidence) pairs
+        """
+
+        arrays, widths = zip(*examples)
+        batch_width = self.max_image_width
+        if self.dynamic_width:
+            batch_width = compute_batch_width(widths, self.max_image_width)
+            seq_len = compute_sample_seq_len(widths, compute_seq_len(batch_width))
+        elif self.width_buckets:
+            seq_len = compute_sample_seq_len(widths, self.max_char_count)
+        else:
+            seq_len = [self.max_char_count] * len(arrays)
+
+        batch_x = np.reshape(
+            np.swapaxes(np.array(arrays, dtype=np.uint8)[:, :, :batch_width], 1, 2),
+            (len(arrays), batch_width, 32, 1),
+        )
+        feed_dict = {self.inputs: normalize_batch(batch_x), self.seq_len: seq_len}
+
+        if self.lexicon is not None:
+            logits = self.session.run(self.logits, feed_dict=feed_dict)
+            predictions, log_probs = zip(*self.lexicon.decode(logits, seq_len))
+            predictions, confidence = list(predictions), np.exp(log_probs)
+        elif self.cascade_threshold is not None:
+            predictions, confidence = self.cascade(feed_dict)
+        elif with_confidence:
+            if self.confidence is None:
+                raise ValueError("This frozen graph has no confidence output")
+            decoded, confidence = self.session.run(
+                [self.decoded, self.confidence], feed_dict=feed_dict
+            )
+            predictions = self.charset.decode_batch(decoded)
+        else:
+            return self.charset.decode_batch(
+                self.session.run(self.decoded, feed_dict=feed_dict)
+            )
+
+        if with_confidence:
+            return list(zip(predictions, confidence.tolist()))
+        return predictions
+
+    def cascade(self, feed_dict):
+        """
+            Greedy decoding, then beam search on the low confidence sequences only
+        """
+
+        decoded, confidence, logits = self.session.run(
+            list(self.greedy) + [self.logits], feed_dict=feed_dict
+        )
+        predictions = self.charset.decode_batch(decoded)
+
+        retry = np.flatnonzero(confidence < self.cascade_threshold)
+        if len(retry):
+            # Feeding the logits skips the CNN and the BiLSTM
+            decoded, beam_confidence = self.session.run(
+                self.beam,
+                feed_dict={
+                    self.logits: logits[:, retry],
+                    self.seq_len: np.asarray(feed_dict[self.seq_len])[retry],
+                },
+            )
+            for i, prediction, c in zip(
+                retry, self.charset.decode_batch(decoded), beam_confidence
+            ):
+                predictions[i] = prediction
+                confidence[i] = c
+        return predictions, confidence
+
+    def predict(self, images, with_confidence=False, sort_window=8):
+        """
+            Return the decoded string (and confidence) of every image,
+            batch_size images at a time.
+
+            Images are preprocessed sort_window batches at a time, so memory
+            does not grow with the number of images, and sorted by width
+            within that window.
+        """
+
+        images = iter(images)
+        predictions = []
+        while True:
+            examples = [
+                self.preprocess(im)
+                for im in itertools.islice(images, self.batch_size * sort_window)
+            ]
+            if not examples:
+                return predictions
+
+            # Batches are made of images of similar widths so that the BiLSTM
+            # (and the CNN with a dynamic width) only runs as much as they need
+            widths = [e[1] for e in examples]
+            order = np.arange(len(examples))
+            if self.dynamic_width:
+                order = np.argsort(widths, kind="stable")
+            elif self.width_buckets:
+                buckets = np.searchsorted(self.width_buckets, widths)
+                order = np.argsort(buckets, kind="stable")
+
+            window = [None] * len(examples)
+            for i in range(0, len(examples), self.batch_size):
+                batch = order[i: i + self.batch_size]
+                decoded = self.predict_batch(
+                    [examples[j] for j in batch], with_confidence
+                )
+                for j, prediction in zip(batch, decoded):
+                    window[j] = prediction
+            predictions.extend(window)
+
+    def close(self):
+        self.session.close()
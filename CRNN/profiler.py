@@ -0,0 +1,111 @@
+import os
+import json
+from collections import defaultdict
+
+import tensorflow as tf
+from tensorflow.python.client import timeline
+from utils import parse_ranges
+
+
+class StepProfiler(object):
+    """
+        Traces the session.run calls of a window of steps.
+
+        Every traced step writes a Chrome trace (chrome://tracing) to
+        output_dir, and the kernels of all of them are accumulated in a per-op
+        summary written by close(). Ops are also grouped by their top level
+        scope, e.g. conv2d_3, bidirectional-rnn-1 or CTCLoss.
+    """
+
+    def __init__(self, steps, output_dir="profile"):
+        self.steps = set(parse_ranges(steps) if isinstance(steps, str) else steps)
+        self.output_dir = output_dir
+        os.makedirs(output_dir, exist_ok=True)
+
+        self.traced = 0
+        self.ops = defaultdict(lambda: {"type": None, "calls": 0, "micros": 0, "peak_bytes": 0})
+
+    def run_kwargs(self, step):
+        """
+            Extra session.run arguments for step, empty outside of the window
+        """
+
+        if step not in self.steps:
+            return {}
+        return {
+            "options": tf.RunOptions(trace_level=tf.RunOptions.FULL_TRACE),
+            "run_metadata": tf.RunMetadata(),
+        }
+
+    def record(self, name, step, run_kwargs):
+        """
+            Write the trace of a session.run made with run_kwargs(step)
+        """
+
+        if not run_kwargs:
+            return
+        step_stats = run_kwargs["run_metadata"].step_stats
+
+        trace = timeline.Timeline(step_stats).generate_chrome_trace_format(show_memory=True)
+        with open(os.path.join(self.output_dir, "{}-step-{}.json".format(name, step)), "w") as f:
+            f.write(trace)
+
+        for device in step_stats.dev_stats:
+            for node in device.node_stats:
+                op = self.ops[node.node_name]
+                # timeline_label is "name = OpType(inputs)"
+                if op["type"] is None and " = " in node.timeline_label:
+                    op["type"] = node.timeline_label.split(" = ")[1].split("(")[0]
+                op["calls"] += 1
+                op["micros"] += node.all_end_rel_micros
+                op["peak_bytes"] = max(
+                    op["peak_bytes"], sum(m.peak_bytes for m in node.memory)
+                )
+        self.traced += 1
+
+    def summary(self, top=20):
+        groups = defaultdict(lambda: {"micros": 0, "peak_bytes": 0})
+        for name, op in self.ops.items():
+            for key in (("scope", name.split("/")[0]), ("type", op["type"] or name)):
+                group = groups[key]
+                group["micros"] += op["micros"]
+                group["peak_bytes"] = max(group["peak_bytes"], op["peak_bytes"])
+
+        def ranked(items, key):
+            return [
+                dict(item, name=name)
+                for name, item in sorted(items, key=lambda i: i[1][key], reverse=True)[:top]
+            ]
+
+        return {
+            "traced_steps": self.traced,
+            "ops_by_time": ranked(self.ops.items(), "micros"),
+            "ops_by_memory": ranked(self.ops.items(), "peak_bytes"),
+            "types_by_time": ranked(
+                [(k[1], v) for k, v in groups.items() if k[0] == "type"], "micros"
+            ),
+            "scopes_by_time": ranked(
+                [(k[1], v) for k, v in groups.items() if k[0] == "scope"], "micros"
+            ),
+        }
+
+    def close(self):
+        """
+            Write and print the per-op summary of the steps traced so far
+        """
+
+        if not self.traced:
+            return
+        summary = self.summary()
+        with open(os.path.join(self.output_dir, "summary.json"), "w") as f:
+            json.dump(summary, f, indent=2)
+
+        print("Profiled {} steps, traces in {}".format(self.traced, self.output_dir))
+        for title, key in (("scope", "scopes_by_time"), ("op type", "types_by_time")):
+            print("Top by {}:".format(title))
+            for item in summary[key][:10]:
+                print(
+                    "\t{:<40} {:>10.1f} ms {:>10.1f} MB".format(
+                        item["name"], item["micros"] / 1000.0, item["peak_bytes"] / 2 ** 20
+                    )
+                )
@@ -1,10 +1,23 @@
-import argparse
-from crnn import CRNN
 import os
+import argparse
+from crnn import CRNN, convert_checkpoint
+from shards import pack_shards
+from utils import Charset, parse_ranges, session_config, set_cpu_affinity
 
 CHAR_VECTOR = "0123456789abcdefghijklmnopqrstuvwxyzABCDEFGHIJKLMNOPQRSTUVWXYZ-'.!?,\""
 
 
+def positive_int(value):
+    """
+        argparse type of the options that must be at least 1
+    """
+
+    value = int(value)
+    if value < 1:
+        raise argparse.ArgumentTypeError("{} is not a positive integer".format(value))
+    return value
+
+
 def parse_arguments():
     """
         Parse the command line arguments of the program.
@@ -19,6 +32,106 @@ def parse_arguments():
     parser.add_argument(
         "--test", action="store_true", help="Define if we test the model"
     )
+    parser.add_argument(
+        "--serve",
+        action="store_true",
+        help="Serve the frozen model over HTTP with dynamic batching",
+    )
+    parser.add_argument(
+        "--pack",
+        action="store_true",
+        help="Pack the examples into memory-mappable shards at --shards_path",
+    )
+    parser.add_argument(
+        "--convert_checkpoint",
+        action="store_true",
+        help="Rename the LSTM variables of the latest checkpoint of --model_path "
+        "for --rnn_cell and save it to --converted_model_path",
+    )
+    parser.add_argument(
+        "--converted_model_path",
+        type=str,
+        help="Where --convert_checkpoint saves the converted checkpoint",
+        default="./save_converted/",
+    )
+    parser.add_argument(
+        "--export",
+        action="store_true",
+        help="Write an inference-optimized copy of --frozen_model_path to --export_path",
+    )
+    parser.add_argument(
+        "--export_path",
+        type=str,
+        help="Where --export writes the optimized graph",
+        default="./save/optimized.pb",
+    )
+    parser.add_argument(
+        "--quantize",
+        type=str,
+        choices=["int8", "float16"],
+        help="Store the exported weights in 8 bits or half precision",
+        default=None,
+    )
+    parser.add_argument(
+        "--tflite",
+        action="store_true",
+        help="Also export the input -> logits part of the graph as a TFLite model, "
+        "only for graphs frozen with --rnn_cell fused",
+    )
+    parser.add_argument(
+        "--eval_path",
+        type=str,
+        help="Held-out examples on which --export compares the accuracy and speed "
+        "of the exported models with the original one",
+        default=None,
+    )
+    parser.add_argument(
+        "--export_output",
+        type=str,
+        help="JSON file the --eval_path comparison of --export is written to",
+        default=None,
+    )
+    parser.add_argument(
+        "--benchmark",
+        action="store_true",
+        help="Time every stage of the data pipeline and of the model on the images "
+        "of samples/ and test/",
+    )
+    parser.add_argument(
+        "--benchmark_batch_sizes",
+        type=lambda s: [int(b) for b in s.split(",")],
+        help="Comma separated batch sizes to benchmark",
+        default=[1, 16, 64],
+    )
+    parser.add_argument(
+        "--benchmark_widths",
+        type=lambda s: [int(w) for w in s.split(",")],
+        help="Comma separated image widths to benchmark",
+        default=[100],
+    )
+    parser.add_argument(
+        "--benchmark_repeats",
+        type=int,
+        help="Timed calls of every stage",
+        default=20,
+    )
+    parser.add_argument(
+        "--autotune",
+        action="store_true",
+        help="Time --frozen_model_path with a few thread counts and record the fastest",
+    )
+    parser.add_argument(
+        "--autotune_output",
+        type=str,
+        help="JSON file the --autotune results are written to",
+        default="autotune.json",
+    )
+    parser.add_argument(
+        "--benchmark_output",
+        type=str,
+        help="JSON file the benchmark results are written to",
+        default=None,
+    )
     parser.add_argument(
         "-ttr",
         "--train_test_ratio",
@@ -42,6 +155,34 @@ def parse_arguments():
         nargs="?",
         help="The path to the file containing the examples (training samples)",
     )
+    parser.add_argument(
+        "-sp",
+        "--shards_path",
+        type=str,
+        nargs="?",
+        help="The path to the packed shards, used instead of --examples_path when set",
+    )
+    parser.add_argument(
+        "--shard_size",
+        type=int,
+        help="Number of examples per shard when packing",
+        default=50000,
+    )
+    parser.add_argument(
+        "-mp",
+        "--manifest_path",
+        type=str,
+        nargs="?",
+        help="Folder of the manifest of --examples_path, only new or modified "
+        "examples are decoded on later runs",
+    )
+    parser.add_argument(
+        "-lw",
+        "--load_workers",
+        type=int,
+        help="Number of processes decoding the examples when loading them",
+        default=1,
+    )
     parser.add_argument(
         "-bs", "--batch_size", type=int, nargs="?", help="Size of a batch", default=64
     )
@@ -61,6 +202,31 @@ def parse_arguments():
         help="Maximum width of an example before truncating",
         default=100,
     )
+    parser.add_argument(
+        "-wb",
+        "--width_buckets",
+        type=lambda s: [int(w) for w in s.split(",")],
+        help="Comma separated image widths, batches only mix samples of the same bucket "
+        "and get per-sample sequence lengths (e.g. 32,64,100)",
+        default=None,
+    )
+    parser.add_argument(
+        "--dynamic_width",
+        action="store_true",
+        help="Build (and export) the graph with a dynamic image width, "
+        "batches are cropped to their widest image",
+    )
+    parser.add_argument(
+        "--use_tf_data",
+        action="store_true",
+        help="Train from a tf.data pipeline instead of feed_dict",
+    )
+    parser.add_argument(
+        "--num_parallel_calls",
+        type=int,
+        help="Parallel decode/resize/encode calls of the tf.data pipeline",
+        default=4,
+    )
     parser.add_argument(
         "-r",
         "--restore",
@@ -80,6 +246,42 @@ def parse_arguments():
         action="store_true",
         help="Generate training data on the fly with TextRecognitionDataGenerator",
     )
+    parser.add_argument(
+        "--trdg_workers",
+        type=int,
+        help="Number of TRDG rendering processes",
+        default=2,
+    )
+    parser.add_argument(
+        "--trdg_queue_size",
+        type=int,
+        help="Maximum number of rendered batches waiting to be consumed",
+        default=20,
+    )
+    parser.add_argument(
+        "--trdg_shared_memory",
+        action="store_true",
+        help="Pass TRDG batches through shared memory slots instead of a pickling queue",
+    )
+    parser.add_argument(
+        "--trdg_cache_path",
+        type=str,
+        help="Render --trdg_cache_size TRDG samples once per language and charset "
+        "in this folder and train from them",
+        default=None,
+    )
+    parser.add_argument(
+        "--trdg_cache_size",
+        type=int,
+        help="Number of TRDG samples in the cache, a smaller existing cache is topped up",
+        default=100000,
+    )
+    parser.add_argument(
+        "--trdg_fresh_ratio",
+        type=float,
+        help="Fraction of freshly rendered samples mixed with the cached ones",
+        default=0.0,
+    )
     parser.add_argument(
         "-l",
         "--language",
@@ -89,11 +291,169 @@ def parse_arguments():
         default="en",
     )
 
+    parser.add_argument(
+        "-si",
+        "--summary_interval",
+        type=positive_int,
+        help="Decode, compute the error rate and write summaries every N training steps, "
+        "counted across iterations",
+        default=100,
+    )
+
+    parser.add_argument(
+        "--checkpoint_interval",
+        type=positive_int,
+        help="Write a checkpoint every N iterations",
+        default=1,
+    )
+
+    parser.add_argument(
+        "--freeze_interval",
+        type=positive_int,
+        help="Export save/frozen.pb every N iterations",
+        default=1,
+    )
+
+    parser.add_argument(
+        "--decoder",
+        type=str,
+        choices=["greedy", "beam"],
+        help="CTC decoder used in training summaries, --test and --serve. "
+        "(beam by default, --serve then uses the graph's dense_decoded). "
+        "Greedy is much faster, beam search a bit more accurate",
+        default=None,
+    )
+
+    parser.add_argument(
+        "--beam_width",
+        type=int,
+        help="Beam width of the beam search decoder (100 when training and testing, "
+        "--serve keeps the one of the frozen graph unless set)",
+        default=None,
+    )
+
+    parser.add_argument(
+        "--cascade_threshold",
+        type=float,
+        help="With --serve, decode greedily and run the beam search only on the "
+        "sequences whose confidence is below this threshold",
+        default=None,
+    )
+
+    parser.add_argument(
+        "--lexicon_path",
+        type=str,
+        help="With --serve, only predict the words of this file (one per line). "
+        "Cannot be used with --cascade_threshold",
+        default=None,
+    )
+
+    parser.add_argument(
+        "--profile_steps",
+        type=str,
+        help="Trace these training steps and test batches (e.g. 10-15 or 3,7) and "
+        "write Chrome traces and a per-op summary to --profile_dir",
+        default=None,
+    )
+
+    parser.add_argument(
+        "--profile_dir",
+        type=str,
+        help="Folder of the --profile_steps traces",
+        default="profile",
+    )
+
+    parser.add_argument(
+        "--intra_op_threads",
+        type=int,
+        help="Threads running a single op (0 uses every core)",
+        default=0,
+    )
+
+    parser.add_argument(
+        "--inter_op_threads",
+        type=int,
+        help="Ops run in parallel (0 uses every core)",
+        default=0,
+    )
+
+    for name in ("constant_folding", "layout_optimizer", "remapping"):
+        parser.add_argument(
+            "--" + name,
+            type=str,
+            choices=["on", "off"],
+            help="Turn the {} graph optimization on or off".format(name.replace("_", " ")),
+            default=None,
+        )
+
+    parser.add_argument(
+        "--cpu_affinity",
+        type=str,
+        help="Cores the process is pinned to, e.g. 0-15 or 0,2,4 (Linux only)",
+        default=None,
+    )
+
+    parser.add_argument(
+        "--rnn_cell",
+        type=str,
+        choices=["basic", "fused"],
+        help="BasicLSTMCell layers or fused LSTM kernels (faster on CPU). "
+        "Checkpoints of one can be used by the other after --convert_checkpoint",
+        default="basic",
+    )
+
+    parser.add_argument(
+        "--rnn_hidden_size",
+        type=int,
+        help="Hidden units of each LSTM direction",
+        default=256,
+    )
+
+    parser.add_argument(
+        "-dp",
+        "--data_parallel",
+        type=int,
+        help="Train in N local processes, each on its share of the data, averaging "
+        "their gradients at every step",
+        default=1,
+    )
+
     parser.add_argument("-lr", "--learning_rate",
                         type=float,
                         help="Learning Rate for Adam Optimizer",
                         default=0.0001)
 
+    parser.add_argument(
+        "--frozen_model_path",
+        type=str,
+        help="The frozen graph used by --serve",
+        default="./save/frozen.pb",
+    )
+    parser.add_argument(
+        "--host", type=str, help="Host the server listens on", default="127.0.0.1"
+    )
+    parser.add_argument(
+        "--port", type=int, help="Port the server listens on", default=5000
+    )
+    parser.add_argument(
+        "--max_batch_size",
+        type=int,
+        help="Maximum number of requests decoded in one session.run",
+        default=32,
+    )
+    parser.add_argument(
+        "--max_wait_ms",
+        type=float,
+        help="Maximum time a request waits for its batch to fill up",
+        default=10,
+    )
+    parser.add_argument(
+        "--queue_size",
+        type=int,
+        help="Maximum number of pending requests before the server answers 503",
+        default=256,
+    )
+
     # parser.add_argument('-fcnn', '--freeze_cnn',
     #                     action='store_true', help="Freeze CNN layers")
 
@@ -109,26 +469,58 @@ def main():
 
     args = parse_arguments()
 
-    if not args.train and not args.test:
+    if (
+        not args.train
+        and not args.test
+        and not args.serve
+        and not args.pack
+        and not args.benchmark
+        and not args.autotune
+        and not args.convert_checkpoint
+        and not args.export
+    ):
         print("If we are not training, and not testing, what is the point?")
 
+    # Before any session or worker process is created, they inherit it
+    if args.cpu_affinity:
+        set_cpu_affinity(parse_ranges(args.cpu_affinity))
+
+    optimizer_options = {
+        "constant_folding": args.constant_folding,
+        "layout_optimizer": args.layout_optimizer,
+        "remapping": args.remapping,
+    }
+    config = session_config(
+        args.intra_op_threads, args.inter_op_threads, **optimizer_options
+    )
+
     crnn = None
 
-    charset = ""
-    if os.path.isfile(args.char_set_string):
-        # if charset is file read from file.
-        with open(args.char_set_string, "r") as f:
-            while True:
-                c = f.readline()
-                charset += c.strip("\n")
-                if not c:
-                    charset += "\n"  # Add line break to charset at the end
-                    break
-    else:
-        charset = args.char_set_string
+    charset = Charset.load(args.char_set_string).char_vector
+
+    if args.convert_checkpoint:
+        convert_checkpoint(args.model_path, args.converted_model_path, args.rnn_cell)
+
+    if args.pack:
+        pack_shards(
+            args.examples_path,
+            args.shards_path,
+            args.max_image_width,
+            charset,
+            args.shard_size,
+        )
 
     if args.train:
-        crnn = CRNN(
+        # Data-parallel workers share the cores unless told otherwise
+        worker_config = config
+        if args.data_parallel > 1 and not args.intra_op_threads:
+            worker_config = session_config(
+                max(1, os.cpu_count() // args.data_parallel),
+                args.inter_op_threads,
+                **optimizer_options
+            )
+
+        crnn_args = [
             args.batch_size,
             args.model_path,
             args.examples_path,
@@ -138,10 +530,41 @@ def main():
             charset,
             args.use_trdg,
             args.language,
-            args.learning_rate
-        )
+            args.learning_rate,
+            args.shards_path,
+            args.width_buckets,
+            args.dynamic_width,
+            args.use_tf_data,
+            args.num_parallel_calls,
+            args.trdg_workers,
+            args.trdg_queue_size,
+            args.trdg_shared_memory,
+            args.trdg_cache_path,
+            args.trdg_cache_size,
+            args.trdg_fresh_ratio,
+            args.load_workers,
+            args.manifest_path,
+            args.summary_interval,
+            args.checkpoint_interval,
+            args.freeze_interval,
+            args.decoder or "beam",
+            args.beam_width or 100,
+            args.profile_steps,
+            args.profile_dir,
+            worker_config,
+            args.rnn_cell,
+            args.rnn_hidden_size,
+        ]
 
-        crnn.train(args.iteration_count)
+        if args.data_parallel > 1:
+            from distributed import train_data_parallel
+
+            train_data_parallel(
+                args.data_parallel, args.iteration_count, crnn_args, {}
+            )
+        else:
+            crnn = CRNN(*crnn_args)
+            crnn.train(args.iteration_count)
 
     if args.test:
         if crnn is None:
@@ -151,15 +574,99 @@ def main():
                 args.examples_path,
                 args.max_image_width,
                 0,
-                args.restore,
+                # Data-parallel training happened in other processes
+                args.restore or args.data_parallel > 1,
                 charset,
                 args.use_trdg,
                 args.language,
-                args.learning_rate
+                args.learning_rate,
+                args.shards_path,
+                args.width_buckets,
+                args.dynamic_width,
+                trdg_workers=args.trdg_workers,
+                trdg_queue_size=args.trdg_queue_size,
+                trdg_shared_memory=args.trdg_shared_memory,
+                trdg_cache_path=args.trdg_cache_path,
+                trdg_cache_size=args.trdg_cache_size,
+                trdg_fresh_ratio=args.trdg_fresh_ratio,
+                load_workers=args.load_workers,
+                manifest_path=args.manifest_path,
+                decoder=args.decoder or "beam",
+                beam_width=args.beam_width or 100,
+                profile_steps=args.profile_steps,
+                profile_dir=args.profile_dir,
+                session_config=config,
+                rnn_cell=args.rnn_cell,
+                rnn_hidden_size=args.rnn_hidden_size,
             )
 
         crnn.test()
 
+    if crnn is not None:
+        crnn.data_manager.close()
+
+    if args.export:
+        from export import export
+
+        export(
+            args.frozen_model_path,
+            args.export_path,
+            charset,
+            args.max_image_width,
+            quantize=args.quantize,
+            tflite=args.tflite,
+            eval_path=args.eval_path,
+            report_path=args.export_output,
+        )
+
+    if args.benchmark:
+        from benchmark import run_benchmark
+
+        run_benchmark(
+            charset,
+            args.benchmark_batch_sizes,
+            args.benchmark_widths,
+            args.benchmark_repeats,
+            args.model_path,
+            restore=args.restore,
+            dynamic_width=args.dynamic_width,
+            output_path=args.benchmark_output,
+            config=config,
+        )
+
+    if args.autotune:
+        from benchmark import autotune_threads
+
+        autotune_threads(
+            args.frozen_model_path,
+            charset,
+            args.max_batch_size,
+            args.benchmark_repeats,
+            max_image_width=args.max_image_width,
+            output_path=args.autotune_output,
+            **optimizer_options
+        )
+
+    if args.serve:
+        from predictor import Predictor
+        from server import MicroBatcher, create_app
+
+        predictor = Predictor(
+            args.frozen_model_path,
+            charset,
+            width_buckets=args.width_buckets,
+            max_image_width=args.max_image_width,
+            decoder=args.decoder,
+            beam_width=args.beam_width,
+            cascade_threshold=args.cascade_threshold,
+            lexicon_path=args.lexicon_path,
+            session_config=config,
+        )
+        batcher = MicroBatcher(
+            predictor, args.max_batch_size, args.max_wait_ms, args.queue_size
+        )
+        create_app(batcher).run(host=args.host, port=args.port, threaded=True)
+
 
 if __name__ == "__main__":
     main()
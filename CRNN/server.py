@@ -0,0 +1,123 @@
+import queue
+import threading
+import time
+from collections import Counter
+from concurrent.futures import Future
+
+from flask import Flask, jsonify, request
+from PIL import Image
+
+
+class MicroBatcher(object):
+    """
+        Collects concurrent requests into dynamic batches for a Predictor.
+
+        A batch is closed when it reaches max_batch_size or when max_wait_ms
+        have passed since its first request, then decoded with one session.run.
+    """
+
+    def __init__(self, predictor, max_batch_size, max_wait_ms, queue_size):
+        self.predictor = predictor
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait_ms / 1000.0
+        self.requests = queue.Queue(maxsize=queue_size)
+        # Submitters check and fill the free room of the queue atomically
+        self.submit_lock = threading.Lock()
+
+        self.lock = threading.Lock()
+        self.batch_size_histogram = Counter()
+        self.queue_depth_histogram = Counter()
+        self.rejected = 0
+
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def submit(self, examples):
+        """
+            Enqueue preprocessed examples (see Predictor.preprocess) and return
+            a future per example. Either all of them are queued or none is,
+            queue.Full is raised when the queue has no room for all of them.
+        """
+
+        with self.submit_lock:
+            # Only the batching thread takes from the queue, the free room
+            # can only grow until the puts below are done
+            if self.requests.maxsize - self.requests.qsize() < len(examples):
+                with self.lock:
+                    self.rejected += len(examples)
+                raise queue.Full
+
+            futures = []
+            for example in examples:
+                futures.append(Future())
+                self.requests.put_nowait((example, futures[-1]))
+        return futures
+
+    def next_batch(self):
+        batch = [self.requests.get()]
+        deadline = time.time() + self.max_wait
+        while len(batch) < self.max_batch_size:
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                break
+            try:
+                batch.append(self.requests.get(timeout=remaining))
+            except queue.Empty:
+                break
+        return batch
+
+    def run(self):
+        while True:
+            batch = self.next_batch()
+            with self.lock:
+                self.batch_size_histogram[len(batch)] += 1
+                self.queue_depth_histogram[self.requests.qsize()] += 1
+
+            examples, futures = zip(*batch)
+            try:
+                predictions = self.predictor.predict_batch(list(examples))
+            except Exception as ex:
+                for future in futures:
+                    future.set_exception(ex)
+                continue
+            for future, prediction in zip(futures, predictions):
+                future.set_result(prediction)
+
+    def stats(self):
+        with self.lock:
+            return {
+                "queue_depth": self.requests.qsize(),
+                "queue_size": self.requests.maxsize,
+                "rejected": self.rejected,
+                "batch_size_histogram": dict(self.batch_size_histogram),
+                "queue_depth_histogram": dict(self.queue_depth_histogram),
+            }
+
+
+def create_app(batcher):
+    app = Flask(__name__)
+
+    @app.route("/predict", methods=["POST"])
+    def predict():
+        files = request.files.getlist("image")
+        if not files:
+            return jsonify({"error": "No image in request"}), 400
+
+        # Every upload is decoded before anything is queued
+        try:
+            examples = [batcher.predictor.preprocess(Image.open(f.stream)) for f in files]
+        except (IOError, OSError, ValueError) as ex:
+            return jsonify({"error": "Invalid image: {}".format(ex)}), 400
+
+        try:
+            futures = batcher.submit(examples)
+        except queue.Full:
+            return jsonify({"error": "Request queue is full"}), 503
+
+        return jsonify({"predictions": [f.result() for f in futures]})
+
+    @app.route("/stats", methods=["GET"])
+    def stats():
+        return jsonify(batcher.stats())
+
+    return app
@@ -0,0 +1,230 @@
+import os
+import json
+import numpy as np
+
+from PIL import Image
+from utils import resize_image, get_charset, Charset
+
+SHARD_INDEX = "index.json"
+SHARD_ARRAYS = ("images", "labels", "offsets", "widths", "texts")
+
+
+def label_length(f):
+    """
+        Length of the label of an example file once encoded, the one compared
+        to max_char_count by every dataset
+    """
+
+    return len(Charset.clean(f.split("_")[0]))
+
+
+def load_example(f, examples_path, max_image_width, char_vector):
+    """
+        Decode, resize and encode one file of examples_path
+
+        return: ("ok", (img_arr, label_string, label_index_array, width)), or
+                ("unreadable", None) and ("charset", None) for skipped files
+    """
+
+    label = f.split("_")[0]
+    charset = get_charset(char_vector)
+    if not charset.contains(label):
+        return "charset", None
+
+    try:
+        arr, width = resize_image(
+            np.array(Image.open(os.path.join(examples_path, f), mode="r")),
+            max_image_width,
+        )
+    except (IOError, OSError):
+        return "unreadable", None
+
+    return "ok", (arr, label, charset.encode(label), width)
+
+
+def write_shard(path, examples, max_image_width):
+    """
+        Write a list of (img_arr, label_string, label_index_array, width) tuples
+        as memory-mappable .npy files in the path directory
+    """
+
+    os.makedirs(path, exist_ok=True)
+
+    images = np.zeros((len(examples), 32, max_image_width), dtype=np.uint8)
+    for i, example in enumerate(examples):
+        images[i] = example[0]
+
+    lengths = [len(example[2]) for example in examples]
+    offsets = np.zeros(len(examples) + 1, dtype=np.int64)
+    offsets[1:] = np.cumsum(lengths)
+    labels = np.zeros(offsets[-1], dtype=np.int32)
+    for i, example in enumerate(examples):
+        labels[offsets[i]: offsets[i + 1]] = example[2]
+
+    np.save(os.path.join(path, "images.npy"), images)
+    np.save(os.path.join(path, "labels.npy"), labels)
+    np.save(os.path.join(path, "offsets.npy"), offsets)
+    np.save(
+        os.path.join(path, "widths.npy"),
+        np.array([example[3] for example in examples], dtype=np.int32),
+    )
+    np.save(
+        os.path.join(path, "texts.npy"),
+        np.array([example[1] for example in examples], dtype=np.str_),
+    )
+
+
+def read_shard(path):
+    """
+        Memory-map the arrays of a shard written by write_shard
+    """
+
+    return {
+        name: np.load(os.path.join(path, name + ".npy"), mmap_mode="r")
+        for name in SHARD_ARRAYS
+    }
+
+
+def shard_row(arrays, j):
+    """
+        (img_arr, label_string, label_index_array, width) tuple of row j of a read_shard
+    """
+
+    offsets = arrays["offsets"]
+    return (
+        arrays["images"][j],
+        str(arrays["texts"][j]),
+        arrays["labels"][offsets[j]: offsets[j + 1]],
+        int(arrays["widths"][j]),
+    )
+
+
+def pack_shards(examples_path, output_path, max_image_width, char_vector, shard_size):
+    """
+        Decode, resize and encode every example of examples_path once and write
+        them in shards of shard_size examples under output_path
+    """
+
+    print("Packing {} into {}".format(examples_path, output_path))
+
+    shards = []
+    examples = []
+
+    def flush():
+        name = "shard-{:05d}".format(len(shards))
+        write_shard(os.path.join(output_path, name), examples, max_image_width)
+        shards.append({"name": name, "count": len(examples)})
+        print("\t{} written ({} examples)".format(name, len(examples)))
+
+    skipped = {"unreadable": 0, "charset": 0}
+    for f in sorted(os.listdir(examples_path)):
+        status, example = load_example(f, examples_path, max_image_width, char_vector)
+        if status != "ok":
+            skipped[status] += 1
+            continue
+        examples.append(example)
+        if len(examples) >= shard_size:
+            flush()
+            examples = []
+
+    if examples:
+        flush()
+
+    print(
+        "Skipped {} unreadable files and {} labels out of the charset".format(
+            skipped["unreadable"], skipped["charset"]
+        )
+    )
+    write_index(output_path, max_image_width, char_vector, shards)
+
+
+def write_index(path, max_image_width, char_vector, shards):
+    """
+        Write the index listing the {"name": ..., "count": ...} shards of path
+    """
+
+    # Replaced at once, readers never see a partly written index
+    index_file = os.path.join(path, SHARD_INDEX)
+    with open(index_file + ".tmp", "w") as f:
+        json.dump(
+            {
+                "max_image_width": max_image_width,
+                "char_vector": char_vector,
+                "count": sum(shard["count"] for shard in shards),
+                "shards": shards,
+            },
+            f,
+        )
+    os.replace(index_file + ".tmp", index_file)
+
+
+class ShardDataset(object):
+    """
+        Read-only, memory-mapped view over shards written by pack_shards.
+
+        Indexing returns the same (img_arr, label_string, label_index_array, width)
+        tuples as DataManager.load_data, slicing returns a list of them.
+    """
+
+    def __init__(self, path, max_image_width, char_vector, max_char_count, rows=None):
+        """
+            rows optionally selects (shard_name, row) examples, in that order,
+            instead of every example of every shard
+        """
+
+        with open(os.path.join(path, SHARD_INDEX), "r") as f:
+            index = json.load(f)
+
+        if index["max_image_width"] != max_image_width:
+            raise Exception(
+                "Shards were packed with max_image_width {}, not {}".format(
+                    index["max_image_width"], max_image_width
+                )
+            )
+        if index["char_vector"] != char_vector:
+            raise Exception("Shards were packed with a different charset")
+
+        self.shards = [
+            read_shard(os.path.join(path, shard["name"])) for shard in index["shards"]
+        ]
+
+        if rows is None:
+            shard_ids = np.concatenate(
+                [
+                    np.full(shard["count"], i, dtype=np.int32)
+                    for i, shard in enumerate(index["shards"])
+                ]
+                + [np.zeros(0, np.int32)]
+            )
+            example_ids = np.concatenate(
+                [np.arange(shard["count"]) for shard in index["shards"]]
+                + [np.zeros(0, np.int64)]
+            )
+        else:
+            shard_index = {shard["name"]: i for i, shard in enumerate(index["shards"])}
+            shard_ids = np.array(
+                [shard_index[name] for name, _ in rows], dtype=np.int32
+            )
+            example_ids = np.array([row for _, row in rows], dtype=np.int64)
+
+        lengths = np.zeros(len(example_ids), dtype=np.int64)
+        widths = np.zeros(len(example_ids), dtype=np.int32)
+        for i, arrays in enumerate(self.shards):
+            selected = shard_ids == i
+            lengths[selected] = np.diff(arrays["offsets"])[example_ids[selected]]
+            widths[selected] = arrays["widths"][example_ids[selected]]
+
+        # Same filter as load_data (see label_length), computed from the offsets only
+        keep = lengths <= max_char_count
+        self.shard_ids = shard_ids[keep]
+        self.example_ids = example_ids[keep]
+        self.widths = widths[keep]
+
+    def __len__(self):
+        return len(self.example_ids)
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return [self[j] for j in range(*i.indices(len(self)))]
+
+        return shard_row(self.shards[self.shard_ids[i]], self.example_ids[i])
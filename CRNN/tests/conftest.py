@@ -0,0 +1,5 @@
+import os
+import sys
+
+# The modules of CRNN/ import each other as top level modules, as when run.py is run from there
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
@@ -0,0 +1,71 @@
+import numpy as np
+import pytest
+
+tf = pytest.importorskip("tensorflow")
+
+from benchmark import IMAGE_DIRS, list_images, write_examples
+from crnn import CRNN, convert_checkpoint
+from utils import compute_seq_len
+
+CHAR_VECTOR = "0123456789abcdefghijklmnopqrstuvwxyzABCDEFGHIJKLMNOPQRSTUVWXYZ-'.!?,\""
+WIDTH = 100
+BATCH_SIZE = 2
+
+
+def build_crnn(model_path, examples_path, rnn_cell):
+    return CRNN(
+        BATCH_SIZE,
+        model_path,
+        examples_path,
+        WIDTH,
+        0.5,
+        False,
+        CHAR_VECTOR,
+        False,
+        "en",
+        0.0001,
+        rnn_cell=rnn_cell,
+        rnn_hidden_size=16,
+    )
+
+
+def compute_logits(crnn, inputs, seq_len):
+    # shape: [max_time, batch_size, num_classes]
+    return crnn.session.run(crnn.logits, {crnn.inputs: inputs, crnn.seq_len: seq_len})
+
+
+def test_basic_checkpoint_restores_into_fused_graph(tmp_path, monkeypatch):
+    # CRNN writes its summaries in the working directory
+    monkeypatch.chdir(tmp_path)
+    examples_path = tmp_path / "examples"
+    examples_path.mkdir()
+    write_examples(list_images(IMAGE_DIRS), str(examples_path), 8, compute_seq_len(WIDTH))
+    basic_path, fused_path = str(tmp_path / "basic"), str(tmp_path / "fused")
+    # Variable sequence lengths exercise the reversed backward pass too
+    inputs = np.random.RandomState(0).rand(BATCH_SIZE, WIDTH, 32, 1).astype(np.float32)
+    seq_len = np.array([compute_seq_len(WIDTH), compute_seq_len(WIDTH) - 5], dtype=np.int32)
+
+    with tf.Graph().as_default():
+        crnn = build_crnn(basic_path, str(examples_path), "basic")
+        try:
+            expected = compute_logits(crnn, inputs, seq_len)
+            crnn.saver.save(crnn.session, crnn.save_path, global_step=1)
+        finally:
+            crnn.data_manager.close()
+            crnn.session.close()
+
+    convert_checkpoint(basic_path, fused_path, "fused")
+
+    with tf.Graph().as_default():
+        crnn = build_crnn(fused_path, str(examples_path), "fused")
+        try:
+            crnn.saver.restore(crnn.session, tf.train.latest_checkpoint(fused_path))
+            logits = compute_logits(crnn, inputs, seq_len)
+        finally:
+            crnn.data_manager.close()
+            crnn.session.close()
+
+    for i, length in enumerate(seq_len):
+        np.testing.assert_allclose(
+            logits[:length, i], expected[:length, i], rtol=1e-4, atol=1e-4
+        )
@@ -0,0 +1,34 @@
+import numpy as np
+import pytest
+
+tf = pytest.importorskip("tensorflow")
+
+from crnn import ctc_decoders
+from export import greedy_decode
+from utils import Charset
+
+
+def one_hot_logits(path, num_classes):
+    # [max_time, batch_size=1, num_classes] logits whose best path is path
+    logits = np.full((len(path), 1, num_classes), -10.0, dtype=np.float32)
+    for t, c in enumerate(path):
+        logits[t, 0, c] = 10.0
+    return logits
+
+
+def test_decoders_collapse_repeats_alike():
+    charset = Charset("ab")
+    blank = 2
+    # a a - a b b - b: repeats are merged unless a blank separates them
+    logits = one_hot_logits([0, 0, blank, 0, 1, 1, blank, 1], 3)
+    seq_len = np.array([len(logits)], dtype=np.int32)
+
+    with tf.Graph().as_default(), tf.Session() as session:
+        greedy, beam, _ = ctc_decoders(tf.constant(logits), tf.constant(seq_len), 10)
+        greedy, beam = session.run(
+            [tf.sparse_tensor_to_dense(greedy[0]), tf.sparse_tensor_to_dense(beam[0])]
+        )
+
+    assert charset.decode(greedy[0]) == "aabb"
+    assert charset.decode(beam[0]) == "aabb"
+    assert greedy_decode(logits, seq_len, charset) == ["aabb"]
@@ -0,0 +1,48 @@
+import multiprocessing
+
+import numpy as np
+
+from distributed import AllReduce
+
+
+def worker_arrays(rank):
+    return [np.full((2, 3), rank, dtype=np.float32), np.arange(5, dtype=np.float32) * (rank + 1)]
+
+
+def run_worker(rank, num_workers, path, barrier, results):
+    all_reduce = AllReduce(path, rank, num_workers, barrier)
+    arrays = worker_arrays(rank)
+    # Twice, the second call reuses the buffers of the first one
+    results.put((rank, "mean", all_reduce.mean(arrays), all_reduce.mean(arrays)))
+    results.put((rank, "broadcast", all_reduce.broadcast(arrays)))
+
+
+def test_all_reduce_mean_and_broadcast(tmp_path):
+    num_workers = 2
+    context = multiprocessing.get_context("spawn")
+    barrier = context.Barrier(num_workers, timeout=60)
+    results = context.Queue()
+    processes = [
+        context.Process(
+            target=run_worker, args=(rank, num_workers, str(tmp_path), barrier, results)
+        )
+        for rank in range(num_workers)
+    ]
+    for p in processes:
+        p.start()
+    outputs = [results.get(timeout=60) for _ in range(2 * num_workers)]
+    for p in processes:
+        p.join(60)
+        assert p.exitcode == 0
+
+    expected_mean = [
+        np.mean([worker_arrays(rank)[i] for rank in range(num_workers)], axis=0)
+        for i in range(2)
+    ]
+    for output in outputs:
+        rank, name, arrays = output[0], output[1], output[2:]
+        for result in arrays:
+            expected = expected_mean if name == "mean" else worker_arrays(0)
+            for array, expected_array in zip(result, expected):
+                assert array.shape == expected_array.shape
+                np.testing.assert_allclose(array, expected_array)
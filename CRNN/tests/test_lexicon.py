@@ -0,0 +1,86 @@
+import math
+
+import numpy as np
+import pytest
+
+from lexicon import LexiconDecoder, Trie, log_add, NEG_INF
+from utils import Charset
+
+CHAR_VECTOR = "abcd"
+WORDS = ["a", "ab", "abc", "bad", "cab", "dd", "add"]
+
+
+def ctc_log_prob(log_probs, label, blank):
+    """
+        log p(label | log_probs) with the CTC forward algorithm
+    """
+
+    extended = [blank]
+    for c in label:
+        extended += [c, blank]
+
+    alpha = [NEG_INF] * len(extended)
+    alpha[0] = log_probs[0, blank]
+    if label:
+        alpha[1] = log_probs[0, label[0]]
+    for step in log_probs[1:]:
+        previous = alpha
+        alpha = []
+        for s, c in enumerate(extended):
+            total = previous[s]
+            if s > 0:
+                total = log_add(total, previous[s - 1])
+            if s > 1 and c != blank and c != extended[s - 2]:
+                total = log_add(total, previous[s - 2])
+            alpha.append(total + float(step[c]))
+    return log_add(alpha[-1], alpha[-2]) if label else alpha[-1]
+
+
+@pytest.fixture
+def lexicon_path(tmp_path):
+    path = tmp_path / "words.txt"
+    # "e" is not in the charset, the word is skipped
+    path.write_text("\n".join(WORDS + ["bee"]) + "\n")
+    return str(path)
+
+
+def test_trie():
+    trie = Trie()
+    trie.add("ab", [0, 1])
+    trie.add("a", [0])
+    trie.add("", [])
+
+    assert len(trie) == 2
+    assert trie.words[trie.children[0][0]] == "a"
+    assert trie.words[trie.children[trie.children[0][0]][1]] == "ab"
+
+
+def test_lexicon_decoder_matches_brute_force(lexicon_path):
+    charset = Charset(CHAR_VECTOR)
+    blank = len(CHAR_VECTOR)
+    # Wide enough to never drop a prefix, so the search is exact
+    decoder = LexiconDecoder(lexicon_path, CHAR_VECTOR, beam_width=1000, prune_log_prob=NEG_INF)
+    assert len(decoder.trie) == len(WORDS)
+
+    rng = np.random.RandomState(0)
+    for _ in range(20):
+        max_time = rng.randint(3, 8)
+        logits = rng.normal(scale=3.0, size=(max_time, 1, blank + 1)).astype(np.float32)
+        log_probs = logits[:, 0] - np.log(np.exp(logits[:, 0]).sum(axis=1, keepdims=True))
+
+        expected = {
+            word: ctc_log_prob(log_probs, charset.encode(word), blank) for word in WORDS
+        }
+        best = max(expected, key=expected.get)
+
+        (word, log_prob), = decoder.decode(logits, [max_time])
+        assert word == best
+        assert math.isclose(log_prob, expected[best], rel_tol=1e-4, abs_tol=1e-4)
+
+
+def test_lexicon_decoder_without_fitting_word(lexicon_path):
+    decoder = LexiconDecoder(lexicon_path, CHAR_VECTOR)
+    # Only "d" is likely and a single step cannot hold "dd"
+    logits = np.array([[[-10.0, -10.0, -10.0, 10.0, -10.0]]], dtype=np.float32)
+
+    assert decoder.decode(logits, [1]) == [("", NEG_INF)]
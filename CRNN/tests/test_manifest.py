@@ -0,0 +1,79 @@
+import os
+import json
+import multiprocessing
+
+import pytest
+from PIL import Image
+
+pytest.importorskip("tensorflow")
+
+from data_manager import DataManager, MANIFEST
+from utils import compute_seq_len
+
+CHAR_VECTOR = "abc"
+WIDTH = 100
+
+
+def write_images(path, count):
+    for i in range(count):
+        label = CHAR_VECTOR[i % len(CHAR_VECTOR)] * (1 + i % 4)
+        Image.new("L", (40 + i, 32), color=i % 256).save(
+            os.path.join(path, "{}_{}.png".format(label, i))
+        )
+
+
+def load_rank(rank, examples_path, manifest_path, data_ready, results):
+    data_manager = DataManager(
+        2,
+        manifest_path,
+        examples_path,
+        WIDTH,
+        0.5,
+        compute_seq_len(WIDTH),
+        CHAR_VECTOR,
+        False,
+        "en",
+        manifest_path=manifest_path,
+        shard_index=rank,
+        num_shards=2,
+        data_ready=data_ready,
+    )
+    try:
+        labels = [data_manager.data[i][1] for i in range(data_manager.data_len)]
+        results.put((rank, labels))
+    finally:
+        data_manager.close()
+
+
+def test_only_rank_0_refreshes_the_manifest(tmp_path):
+    examples_path, manifest_path = str(tmp_path / "examples"), str(tmp_path / "manifest")
+    os.mkdir(examples_path)
+    write_images(examples_path, 12)
+
+    context = multiprocessing.get_context("spawn")
+    data_ready = context.Event()
+    results = context.Queue()
+    processes = {
+        rank: context.Process(
+            target=load_rank, args=(rank, examples_path, manifest_path, data_ready, results)
+        )
+        for rank in (0, 1)
+    }
+
+    # Rank 1 waits for rank 0 instead of building the manifest too
+    processes[1].start()
+    processes[1].join(2)
+    assert processes[1].is_alive()
+    assert not os.path.exists(manifest_path)
+
+    processes[0].start()
+    labels = dict(results.get(timeout=120) for _ in processes)
+    for p in processes.values():
+        p.join(60)
+        assert p.exitcode == 0
+
+    assert len(labels[0]) == 12
+    assert labels[0] == labels[1]
+    with open(os.path.join(manifest_path, MANIFEST)) as f:
+        shards = [shard["name"] for shard in json.load(f)["shards"]]
+    assert sorted(n for n in os.listdir(manifest_path) if n.startswith("shard-")) == shards
@@ -0,0 +1,79 @@
+import numpy as np
+import pytest
+
+from utils import sparse_tuple_from, sparse_tuple_from_lengths, Charset
+
+CHAR_VECTOR = "0123456789abcdefghijklmnopqrstuvwxyz-'.!?,\""
+
+
+def reference_sparse_tuple(sequences):
+    # The loop sparse_tuple_from was vectorized from
+    indices = []
+    values = []
+    for n, seq in enumerate(sequences):
+        indices.extend(zip([n] * len(seq), range(len(seq))))
+        values.extend(seq)
+    indices = np.asarray(indices, dtype=np.int64)
+    shape = np.asarray([len(sequences), indices.max(0)[1] + 1], dtype=np.int64)
+    return indices, np.asarray(values, dtype=np.int32), shape
+
+
+def test_sparse_tuple_from_matches_loop():
+    rng = np.random.RandomState(0)
+    sequences = [list(rng.randint(0, 40, size=n)) for n in (3, 0, 7, 1, 5)]
+
+    for actual, expected in zip(sparse_tuple_from(sequences), reference_sparse_tuple(sequences)):
+        np.testing.assert_array_equal(actual, expected)
+        assert actual.dtype == expected.dtype
+
+
+def test_sparse_tuple_from_lengths():
+    indices, values, shape = sparse_tuple_from_lengths(np.array([4, 5, 6]), [2, 0, 1])
+
+    np.testing.assert_array_equal(indices, [[0, 0], [0, 1], [2, 0]])
+    np.testing.assert_array_equal(values, [4, 5, 6])
+    np.testing.assert_array_equal(shape, [3, 2])
+
+
+def test_sparse_tuple_from_empty_batch():
+    indices, values, shape = sparse_tuple_from([])
+
+    assert indices.shape == (0, 2)
+    assert len(values) == 0
+    np.testing.assert_array_equal(shape, [0, 0])
+
+
+def test_charset_encode_decode():
+    charset = Charset(CHAR_VECTOR)
+
+    assert charset.encode("ab 1\n") == [10, 11, 1]
+    assert charset.decode(charset.encode("hello!")) == "hello!"
+    # -1 is the padding of dense_decoded
+    assert charset.decode_batch([[17, 4, -1], [-1, -1, -1]]) == ["h4", ""]
+
+
+def test_charset_encode_batch_matches_encode():
+    charset = Charset(CHAR_VECTOR)
+    labels = ["hello", "", "it's", "x y z"]
+
+    values, lengths = charset.encode_batch(labels)
+
+    np.testing.assert_array_equal(lengths, [5, 0, 4, 3])
+    np.testing.assert_array_equal(values, sum([charset.encode(l) for l in labels], []))
+
+
+def test_charset_unknown_character():
+    charset = Charset(CHAR_VECTOR)
+
+    assert not charset.contains("héllo")
+    with pytest.raises(ValueError):
+        charset.encode("héllo")
+    with pytest.raises(ValueError):
+        charset.encode_batch(["hello", "HELLO"])
+
+
+def test_charset_duplicate_characters_use_first_index():
+    charset = Charset("abca")
+
+    assert charset.encode("a") == [0]
+    np.testing.assert_array_equal(charset.encode_batch(["aa"])[0], [0, 0])
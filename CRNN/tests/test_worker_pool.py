@@ -0,0 +1,37 @@
+import itertools
+
+import numpy as np
+import pytest
+
+from worker_pool import WorkerPool
+
+
+def batches():
+    for i in itertools.count():
+        yield np.full(3, i)
+
+
+def failing_batches():
+    yield np.zeros(3)
+    raise ValueError("no font for this language")
+
+
+def test_worker_pool_yields_batches():
+    pool = WorkerPool(batches, 2, 4)
+    try:
+        for batch, _ in zip(pool, range(10)):
+            assert batch.shape == (3,)
+        assert sum(pool.stats()["batches"]) >= 10
+    finally:
+        pool.shutdown()
+
+
+def test_worker_pool_raises_worker_errors():
+    pool = WorkerPool(failing_batches, 2, 4)
+    try:
+        with pytest.raises(Exception, match="no font for this language"):
+            for _ in pool:
+                pass
+        assert pool.processes == []
+    finally:
+        pool.shutdown()
@@ -1,7 +1,10 @@
+import os
+import functools
 import numpy as np
 import tensorflow as tf
 
 from PIL import Image
+from tensorflow.core.protobuf import rewriter_config_pb2
 
 
 def sparse_tuple_from(sequences, dtype=np.int32):
@@ -9,17 +12,28 @@ def sparse_tuple_from(sequences, dtype=np.int32):
         Inspired (copied) from https://github.com/igormq/ctc_tensorflow_example/blob/master/utils.py
     """
 
-    indices = []
-    values = []
-    # print(sequences)
-    for n, seq in enumerate(sequences):
-        indices.extend(zip([n] * len(seq), [i for i in range(len(seq))]))
-        values.extend(seq)
+    lengths = np.array([len(seq) for seq in sequences], dtype=np.int64)
+    values = np.concatenate(
+        [np.asarray(seq, dtype=dtype) for seq in sequences] + [np.zeros(0, dtype)]
+    )
+
+    return sparse_tuple_from_lengths(values, lengths)
+
+
+def sparse_tuple_from_lengths(values, lengths):
+    """
+        Same as sparse_tuple_from for sequences already concatenated in values
+    """
+
+    lengths = np.asarray(lengths, dtype=np.int64)
+    starts = np.cumsum(lengths) - lengths
+
+    rows = np.repeat(np.arange(len(lengths), dtype=np.int64), lengths)
+    cols = np.arange(lengths.sum(), dtype=np.int64) - np.repeat(starts, lengths)
 
-    indices = np.asarray(indices, dtype=np.int64)
-    values = np.asarray(values, dtype=dtype)
+    indices = np.stack([rows, cols], axis=1)
     shape = np.asarray(
-        [len(sequences), np.asarray(indices).max(0)[1] + 1], dtype=np.int64
+        [len(lengths), lengths.max() if len(lengths) else 0], dtype=np.int64
     )
 
     return indices, values, shape
@@ -27,6 +41,8 @@ def sparse_tuple_from(sequences, dtype=np.int32):
 
 def resize_image(im_arr, input_width):
     """Resize an image to the "good" input size
+
+    return: uint8 (32, input_width) array and the width of the image inside it
     """
     image = Image.fromarray(im_arr)
     image = image.convert('L')
@@ -37,31 +53,210 @@ def resize_image(im_arr, input_width):
         ratio = float(input_width) / c
         final_arr = np.array(image.resize((input_width, int(32 * ratio))))
     else:
-        final_arr = np.zeros((32, input_width))
+        final_arr = np.zeros((32, input_width), dtype=np.uint8)
         ratio = 32.0 / r
         im_arr_resized = np.array(image.resize((int(c * ratio), 32)))
         final_arr[
             :, 0: min(input_width, np.shape(im_arr_resized)[1])
         ] = im_arr_resized[:, 0:input_width]
+        c = min(input_width, np.shape(im_arr_resized)[1])
     return final_arr, c
 
 
+def parse_ranges(ranges):
+    """
+        "10-15" or "3,7,9" into a sorted list of integers
+    """
+
+    selected = set()
+    for part in ranges.split(","):
+        if "-" in part:
+            start, end = part.split("-")
+            selected.update(range(int(start), int(end) + 1))
+        else:
+            selected.add(int(part))
+    return sorted(selected)
+
+
+def session_config(
+    intra_op_threads=0,
+    inter_op_threads=0,
+    constant_folding=None,
+    layout_optimizer=None,
+    remapping=None,
+):
+    """
+        ConfigProto with the given thread pool sizes (0 lets TensorFlow use
+        every core) and graph optimizer passes turned "on" or "off" (None
+        keeps the TensorFlow default)
+    """
+
+    config = tf.ConfigProto(
+        intra_op_parallelism_threads=intra_op_threads,
+        inter_op_parallelism_threads=inter_op_threads,
+    )
+    rewrite_options = config.graph_options.rewrite_options
+    for name, value in (
+        ("constant_folding", constant_folding),
+        ("layout_optimizer", layout_optimizer),
+        ("remapping", remapping),
+    ):
+        if value is not None:
+            setattr(
+                rewrite_options, name, getattr(rewriter_config_pb2.RewriterConfig, value.upper())
+            )
+    return config
+
+
+def set_cpu_affinity(cpus):
+    """
+        Pin the process to a list of cores, before any session or worker
+        starts so that their threads inherit it (Linux only)
+    """
+
+    os.sched_setaffinity(0, cpus)
+
+
+def normalize_batch(batch_x):
+    """
+        Scale a uint8 batch to [0, 1] float32 in a single pass, right before feeding it
+    """
+
+    return np.multiply(batch_x, np.float32(1.0 / 255.0), dtype=np.float32)
+
+
+def compute_seq_len(width):
+    """
+        Number of time steps the CNN produces for an input of the given width
+        (two 2x2 poolings followed by a 2x2 valid convolution).
+    """
+
+    return width // 4 - 1
+
+
+def compute_batch_width(widths, max_image_width):
+    """
+        Narrowest multiple of 4 holding every image of a batch, plus one time
+        step so that the last columns are not lost by the final convolution
+    """
+
+    return min(max_image_width, (max(widths) + 3) // 4 * 4 + 4)
+
+
+def compute_sample_seq_len(widths, max_char_count):
+    """
+        Time steps covered by images whose content is widths pixels wide, a
+        time step seeing 4 columns of the input
+    """
+
+    return np.clip(-(-np.asarray(widths) // 4), 1, max_char_count).astype(np.int32)
+
+
+class Charset(object):
+    """
+        Codec between label strings and class indices, built once per charset.
+
+        Encoding is a dict lookup per character, or a single searchsorted over
+        the code points of a whole batch; decoding is a lookup array where the
+        -1 padding of dense_decoded maps to an empty string.
+    """
+
+    def __init__(self, char_vector):
+        self.char_vector = char_vector
+
+        self.index = {}
+        for i, c in enumerate(char_vector):
+            self.index.setdefault(c, i)
+
+        codes = np.array([ord(c) for c in char_vector], dtype=np.uint32)
+        self.codes, first = np.unique(codes, return_index=True)
+        self.code_index = first.astype(np.int32)
+
+        self.lookup = np.array(list(char_vector) + [""], dtype=object)
+
+    @classmethod
+    def load(cls, char_set_string):
+        """
+            Build the charset from a file (one character per line) or from the string itself
+        """
+
+        if not os.path.isfile(char_set_string):
+            return cls(char_set_string)
+
+        charset = ""
+        with open(char_set_string, "r") as f:
+            while True:
+                c = f.readline()
+                charset += c.strip("\n")
+                if not c:
+                    charset += "\n"  # Add line break to charset at the end
+                    break
+        return cls(charset)
+
+    def __len__(self):
+        return len(self.char_vector)
+
+    @staticmethod
+    def clean(label):
+        return label.strip("\n").replace(" ", "")
+
+    def contains(self, label):
+        return all(c in self.index for c in self.clean(label))
+
+    def encode(self, label):
+        """
+            Return the index list of label, raises ValueError on unknown characters
+        """
+
+        try:
+            return [self.index[c] for c in self.clean(label)]
+        except KeyError as ex:
+            raise ValueError("Character {} is not in the charset".format(ex))
+
+    def encode_batch(self, labels):
+        """
+            Encode a list of labels at once
+
+            return: concatenated int32 indices and the int64 length of every label
+        """
+
+        labels = [self.clean(label) for label in labels]
+        lengths = np.array([len(label) for label in labels], dtype=np.int64)
+        codes = np.frombuffer("".join(labels).encode("utf-32-le"), dtype=np.uint32)
+
+        pos = np.minimum(np.searchsorted(self.codes, codes), len(self.codes) - 1)
+        unknown = self.codes[pos] != codes
+        if np.any(unknown):
+            raise ValueError(
+                "Character {} is not in the charset".format(
+                    repr(chr(codes[np.argmax(unknown)]))
+                )
+            )
+
+        return self.code_index[pos], lengths
+
+    def decode(self, indices):
+        return "".join(self.lookup[np.asarray(indices, dtype=np.int64)])
+
+    def decode_batch(self, dense_decoded):
+        """
+            Decode a [batch_size, max_decoded_length] array padded with -1
+        """
+
+        return ["".join(row) for row in self.lookup[np.asarray(dense_decoded)]]
+
+
+@functools.lru_cache(maxsize=8)
+def get_charset(char_vector):
+    return Charset(char_vector)
+
+
 def label_to_array(label, char_vector):
-    char = ''
-    label_arr = []
     try:
-        label = label.strip("\n")
-        label = label.replace(" ", "")
-        # print("char index", [char_vector.index(x) for x in label])
-        for x in label:
-            char = x
-            if char_vector.index(x) >= 0:
-                label_arr.append(char_vector.index(x))
-    except Exception as ex:
-        print("Expection raised:", label,
-              'Char type :', type(char), 'char: ', char)
-    finally:
-        return label_arr
+        return get_charset(char_vector).encode(label)
+    except ValueError as ex:
+        print("Expection raised:", label, ex)
+        return []
 
 
 def ground_truth_to_word(ground_truth, char_vector):
@@ -69,12 +264,7 @@ def ground_truth_to_word(ground_truth, char_vector):
         Return the word string based on the input ground_truth
     """
 
-    try:
-        return "".join([char_vector[i] for i in ground_truth if i != -1])
-    except Exception as ex:
-        print(ground_truth)
-        print(ex)
-        input()
+    return get_charset(char_vector).decode(ground_truth)
 
 
 def levenshtein(s1, s2):
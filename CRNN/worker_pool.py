@@ -0,0 +1,247 @@
+import os
+import time
+import queue
+import random
+import ctypes
+import traceback
+import numpy as np
+from multiprocessing import Array, Event, Process, Queue, RawArray
+from utils import sparse_tuple_from_lengths
+
+
+class SharedMemoryRing(object):
+    """
+        Ring of preallocated shared memory slots carrying batches from the
+        worker processes to the trainer without pickling their arrays.
+
+        Workers write pixels, label indices and sequence lengths straight into
+        a free slot and only send its number (and the batch_y strings) through
+        a queue. The trainer gets numpy views on the slot, which stay valid
+        until the next batch is requested.
+    """
+
+    def __init__(self, num_slots, batch_size, max_image_width, max_char_count):
+        self.num_slots = num_slots
+        self.batch_size = batch_size
+        self.max_image_width = max_image_width
+        self.max_char_count = max_char_count
+
+        # RawArray rather than multiprocessing.shared_memory, which needs python 3.8
+        self.buffers = (
+            RawArray(ctypes.c_uint8, num_slots * batch_size * max_image_width * 32),
+            RawArray(ctypes.c_int32, num_slots * batch_size * max_char_count),
+            RawArray(ctypes.c_int64, num_slots * batch_size),
+            RawArray(ctypes.c_int32, num_slots * batch_size),
+        )
+        self.arrays = None
+
+        self.free = Queue()
+        for slot in range(num_slots):
+            self.free.put(slot)
+        self.ready = Queue()
+        self.current = None
+
+    def slot(self, slot):
+        """
+            (pixels, label values, label lengths, seq_len) views on a slot
+        """
+
+        if self.arrays is None:
+            pixels, values, lengths, seq_len = [
+                np.frombuffer(b, dtype=dtype)
+                for b, dtype in zip(self.buffers, (np.uint8, np.int32, np.int64, np.int32))
+            ]
+            self.arrays = (
+                pixels.reshape(
+                    (self.num_slots, self.batch_size, self.max_image_width, 32, 1)
+                ),
+                values.reshape((self.num_slots, -1)),
+                lengths.reshape((self.num_slots, -1)),
+                seq_len.reshape((self.num_slots, -1)),
+            )
+        return tuple(array[slot] for array in self.arrays)
+
+    def put(self, batch, stop_event):
+        """
+            Copy a (batch_y, batch_dt, batch_x, batch_sl) batch into a free slot,
+            returns False if stop_event was set while waiting for one
+        """
+
+        while True:
+            if stop_event.is_set():
+                return False
+            try:
+                slot = self.free.get(timeout=0.5)
+                break
+            except queue.Empty:
+                continue
+
+        batch_y, (indices, values, _), batch_x, batch_sl = batch
+        n, width = batch_x.shape[0], batch_x.shape[1]
+        if len(values) > n * self.max_char_count:
+            raise ValueError("Labels are longer than max_char_count")
+
+        pixels, label_values, label_lengths, seq_len = self.slot(slot)
+        pixels[:n, :width] = batch_x
+        label_values[: len(values)] = values
+        label_lengths[:n] = np.bincount(indices[:, 0], minlength=n)
+        seq_len[:n] = batch_sl
+
+        self.ready.put((slot, n, width, len(values), batch_y))
+        return True
+
+    def get(self, timeout=None):
+        """
+            Views on the next batch, raises queue.Empty after timeout seconds
+        """
+
+        # The views of the previous batch are not used anymore
+        if self.current is not None:
+            self.free.put(self.current)
+            self.current = None
+
+        slot, n, width, count, batch_y = self.ready.get(timeout=timeout)
+        self.current = slot
+
+        pixels, label_values, label_lengths, seq_len = self.slot(slot)
+        return (
+            batch_y,
+            sparse_tuple_from_lengths(label_values[:count], label_lengths[:n]),
+            pixels[:n, :width],
+            seq_len[:n],
+        )
+
+    def qsize(self):
+        return self.ready.qsize()
+
+    def drain(self):
+        try:
+            while True:
+                slot = self.ready.get_nowait()[0]
+                self.free.put(slot)
+        except queue.Empty:
+            pass
+
+
+class WorkerPool(object):
+    """
+        Processes running a batch generator function and filling a bounded queue.
+
+        A worker blocks while the queue is full instead of rendering batches
+        nobody will use. Processes are started by start() or on first
+        iteration and stopped by shutdown(). With a SharedMemoryRing, batches
+        go through its slots instead of the pickling queue. A worker that fails
+        sends its traceback back, the consumer then shuts the pool down and
+        raises it.
+    """
+
+    def __init__(self, generator_fn, num_workers, queue_size, ring=None):
+        self.generator_fn = generator_fn
+        self.ring = ring
+        self.num_workers = num_workers
+        self.queue = Queue(maxsize=queue_size)
+        self.stop_event = Event()
+        # Batches produced by each worker, only written by that worker
+        self.counters = Array("l", num_workers)
+        self.errors = Queue()
+        self.processes = []
+        self.start_time = None
+
+    def work(self, worker_id):
+        # Forked workers share the parent random state, they would all render the same text
+        random.seed(os.getpid())
+        np.random.seed(os.getpid() % 2 ** 32)
+
+        try:
+            self.produce(worker_id)
+        except Exception:
+            # The traceback as text, exceptions are not always picklable
+            self.errors.put("Worker {} failed:\n{}".format(worker_id, traceback.format_exc()))
+            raise
+
+    def produce(self, worker_id):
+        for batch in self.generator_fn():
+            if self.ring is not None:
+                if not self.ring.put(batch, self.stop_event):
+                    return
+                self.counters[worker_id] += 1
+                continue
+
+            while not self.stop_event.is_set():
+                try:
+                    self.queue.put(batch, timeout=0.5)
+                    break
+                except queue.Full:
+                    continue
+            if self.stop_event.is_set():
+                return
+            self.counters[worker_id] += 1
+
+    def start(self):
+        if self.processes:
+            return
+        self.start_time = time.time()
+        for i in range(self.num_workers):
+            self.processes.append(Process(target=self.work, args=(i,), daemon=True))
+            self.processes[-1].start()
+
+    def check_workers(self):
+        """
+            Shut the pool down and raise if a worker failed, or if all of them
+            stopped and nothing would fill the queue anymore
+        """
+
+        exitcodes = [p.exitcode for p in self.processes]
+        if not self.errors.empty():
+            error = self.errors.get()
+        elif any(code not in (None, 0) for code in exitcodes) or None not in exitcodes:
+            error = "Workers stopped with exit codes {}".format(exitcodes)
+        else:
+            return
+        self.shutdown()
+        raise Exception(error)
+
+    def __iter__(self):
+        self.start()
+        while True:
+            try:
+                if self.ring is not None:
+                    batch = self.ring.get(timeout=0.5)
+                else:
+                    batch = self.queue.get(timeout=0.5)
+            except queue.Empty:
+                self.check_workers()
+                continue
+            self.check_workers()
+            yield batch
+
+    def stats(self):
+        """
+            Queue depth and per-worker batch counts and batches per second
+        """
+
+        elapsed = time.time() - self.start_time if self.start_time else 0
+        counts = list(self.counters)
+        return {
+            "queue_depth": self.ring.qsize() if self.ring else self.queue.qsize(),
+            "batches": counts,
+            "batches_per_second": [c / elapsed if elapsed else 0.0 for c in counts],
+        }
+
+    def shutdown(self, timeout=5):
+        self.stop_event.set()
+
+        # Unblock the workers waiting on a full queue
+        if self.ring is not None:
+            self.ring.drain()
+        try:
+            while True:
+                self.queue.get_nowait()
+        except queue.Empty:
+            pass
+
+        for p in self.processes:
+            p.join(timeout)
+            if p.is_alive():
+                p.terminate()
+        self.processes = []